@@ -0,0 +1,259 @@
+"""Benchmarks for graph construction, rule resolution and emission."""
+
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+
+from configure import Build
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+# name: (fan-in, implicit-rule ratio, per-edge var ratio, BuildPath ratio)
+profiles = {
+  "explicit": (2, 0.0, 0.0, 1.0),
+  "implicit": (2, 1.0, 0.0, 1.0),
+  "vars": (2, 0.5, 1.0, 1.0),
+  "fanin": (32, 0.5, 0.1, 1.0),
+  "mixed": (4, 0.5, 0.3, 0.5),
+}
+
+metrics = ["construct", "peakMemory", "resolve", "emit", "manifestBytes"]
+
+timings = frozenset(["construct", "resolve", "emit"])
+
+
+class CountingStream(object):
+  def __init__(self):
+    self.size = 0
+
+  def write(self, data):
+    self.size += len(data)
+
+
+def generate(size, profile, seed = 0):
+  fanIn, implicitRatio, varRatio, pathRatio = profiles[profile]
+  rng = random.Random(seed)
+  build = Build()
+
+  build.set(cflags = "-O2 -Wall")
+
+  for i in range(8):
+    build.rule("cc%i" % (i)).set(
+      command = "cc $cflags -c $in -o $out", description = "CC $out"
+    )
+
+  build.rule("cc", targets = ".o", deps = ".c").set(
+    command = "cc $cflags -c $in -o $out"
+  )
+  build.rule("cxx", targets = ".o", deps = ".cpp").set(
+    command = "c++ $cflags -c $in -o $out"
+  )
+  build.rule("ar", targets = ".a", deps = ".o").set(command = "ar rcs $out $in")
+
+  def path(name, atRoot):
+    if rng.random() >= pathRatio: return name
+
+    return build.path(name) if atRoot else build.path_b(name)
+
+  outputs = list()
+
+  for i in range(size):
+    implicit = rng.random() < implicitRatio
+    ext = ".c" if not implicit or rng.random() < 0.5 else ".cpp"
+
+    if implicit and len(outputs) > fanIn and rng.random() < 0.1:
+      target = path("lib/lib%i.a" % (i), False)
+      deps = rng.sample(outputs, fanIn)
+    else:
+      target = path("obj/%i/src%i.o" % (i % 64, i), False)
+      deps = [
+        path("src/%i/file%i%s" % (i % 64, rng.randrange(size), ext), True)
+        for j in range(rng.randint(1, fanIn))
+      ]
+      outputs.append(target)
+
+    if implicit:
+      edge = build.edge(target, deps)
+    else:
+      edge = build.edge(target, "cc%i" % (i % 8), deps)
+
+    if rng.random() < varRatio:
+      edge.set(cflags = "-O2 -DUNIT=%i" % (i % 16))
+
+  return build
+
+
+def timed(fn):
+  gc.collect()
+  start = time.time()
+  result = fn()
+
+  return time.time() - start, result
+
+
+def peakMemory(fn):
+  if tracemalloc is not None:
+    tracemalloc.start()
+
+    try:
+      fn()
+      return tracemalloc.get_traced_memory()[1]
+    finally:
+      tracemalloc.stop()
+
+  if resource is not None:
+    fn()
+    # Only a process-wide high-water mark is available here
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+  return None
+
+
+def runOne(size, profile, repeat, memory):
+  result = dict()
+
+  for i in range(repeat):
+    construct, build = timed(lambda: generate(size, profile))
+
+    resolve, names = timed(lambda: [edge._getRule() for edge in build._edges])
+
+    # Pin every edge to its resolved rule so nothing below resolves again
+    for edge, name in zip(build._edges, names):
+      edge.setRule(name)
+
+    rules = build._resolve()
+
+    stream = CountingStream()
+    emit, unused = timed(
+      lambda: build._emitGraph(stream, "..", "build", rules)
+    )
+
+    for key, value in [
+        ("construct", construct), ("resolve", resolve), ("emit", emit)
+    ]:
+      result[key] = min(result.get(key, value), value)
+
+    result["manifestBytes"] = stream.size
+    del build, names, rules
+
+  if memory: result["peakMemory"] = peakMemory(lambda: generate(size, profile))
+
+  result["edges"] = size
+
+  return result
+
+
+def compare(results, baseline, threshold, minDelta):
+  regressions = list()
+
+  for name in sorted(results):
+    if name not in baseline: continue
+
+    for metric in metrics:
+      new = results[name].get(metric)
+      old = baseline[name].get(metric)
+
+      if not new or not old: continue
+
+      ratio = float(new) / old
+      flag = ""
+
+      # Timings this small are mostly scheduler noise
+      if ratio > 1 + threshold and (
+          metric not in timings or new - old > minDelta
+      ):
+        flag = "  REGRESSION"
+        regressions.append((name, metric, ratio))
+
+      print("%-20s %-14s %12.6g -> %12.6g (%+.1f%%)%s" % (
+        name, metric, old, new, (ratio - 1) * 100, flag
+      ))
+
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description = __doc__)
+  parser.add_argument(
+    "--sizes", default = "1000,10000,100000",
+    help = "comma-separated edge counts (up to 1000000)"
+  )
+  parser.add_argument(
+    "--profiles", default = ",".join(sorted(profiles)),
+    help = "comma-separated graph shapes: %s" % (", ".join(sorted(profiles)))
+  )
+  parser.add_argument(
+    "--repeat", type = int, default = 3, help = "keep the best of N runs"
+  )
+  parser.add_argument(
+    "--no-memory", action = "store_true", help = "skip peak memory tracing"
+  )
+  parser.add_argument("-o", "--output", help = "write results to this file")
+  parser.add_argument("-b", "--baseline", help = "compare against this file")
+  parser.add_argument(
+    "-t", "--threshold", type = float, default = 0.1,
+    help = "allowed relative regression (default 0.1)"
+  )
+  parser.add_argument(
+    "--min-delta", type = float, default = 0.005,
+    help = "ignore timing regressions smaller than this many seconds "
+    "(default 0.005)"
+  )
+  opts = parser.parse_args()
+
+  if opts.baseline and opts.repeat < 3:
+    parser.error("--baseline needs --repeat of at least 3")
+
+  results = dict()
+
+  for profile in opts.profiles.split(","):
+    if profile not in profiles:
+      parser.error("unknown profile '%s'" % (profile))
+
+    for size in [int(size) for size in opts.sizes.split(",")]:
+      name = "%s/%i" % (profile, size)
+      results[name] = runOne(size, profile, opts.repeat, not opts.no_memory)
+
+      print("%-20s %s" % (name, " ".join(
+        "%s=%.6g" % (metric, results[name][metric]) for metric in metrics
+        if results[name].get(metric) is not None
+      )))
+      sys.stdout.flush()
+
+  if opts.output:
+    with open(opts.output, "w") as fl:
+      json.dump({
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+      }, fl, indent = 2, sort_keys = True)
+
+  if opts.baseline:
+    with open(opts.baseline) as fl:
+      baseline = json.load(fl)["results"]
+
+    regressions = compare(results, baseline, opts.threshold, opts.min_delta)
+
+    if len(regressions):
+      print("%i regressions over %.0f%%." % (
+        len(regressions), opts.threshold * 100
+      ))
+      return 1
+
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
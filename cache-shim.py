@@ -0,0 +1,348 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# Bump to invalidate every entry written by an older layout
+storeVersion = b"cache-shim 1"
+
+
+class FileLock(object):
+  def __init__(self, path, shared = False, block = True):
+    self.path = path
+    self.shared = shared
+    self.block = block
+    self.fd = None
+
+  def __enter__(self):
+    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+
+    if fcntl is not None:
+      op = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+      if not self.block: op |= fcntl.LOCK_NB
+
+      try:
+        fcntl.flock(self.fd, op)
+      except (IOError, OSError):
+        os.close(self.fd)
+        self.fd = None
+        raise
+
+    return self
+
+  def __exit__(self, *args):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+    return False
+
+
+def fileHash(path):
+  hsh = hashlib.sha256()
+
+  with open(path, "rb") as fl:
+    while True:
+      chunk = fl.read(1 << 20)
+      if not chunk: break
+      hsh.update(chunk)
+
+  return hsh.hexdigest()
+
+
+def writeAtomic(path, data):
+  tmp = "%s.%i.tmp" % (path, os.getpid())
+
+  with open(tmp, "wb") as fl:
+    fl.write(data)
+
+  getattr(os, "replace", os.rename)(tmp, path)
+
+
+class Store(object):
+  def __init__(self, path, maxSize):
+    self.path = path
+    self.maxSize = maxSize
+    self.entries = os.path.join(path, "ac")
+    self.blobs = os.path.join(path, "cas")
+
+    for fil in [self.entries, self.blobs]:
+      if not os.path.isdir(fil):
+        try:
+          os.makedirs(fil)
+        except OSError:
+          if not os.path.isdir(fil): raise
+
+  # Entries and blobs are only touched under a shared lock; eviction takes
+  # it exclusively so nothing disappears halfway through a restore
+  def lock(self, shared = True):
+    return FileLock(os.path.join(self.path, ".lock"), shared)
+
+  def entryPath(self, key):
+    return os.path.join(self.entries, "%s.json" % (key))
+
+  def blobPath(self, digest):
+    return os.path.join(self.blobs, digest)
+
+  def key(self, command, inputs, outputs, envVars):
+    hsh = hashlib.sha256(storeVersion + b"\0")
+    hsh.update(command.encode("utf-8") + b"\0")
+
+    for name in sorted(envVars):
+      value = os.environ.get(name)
+      value = "" if value is None else "=" + value
+      hsh.update(("%s%s\0" % (name, value)).encode("utf-8"))
+
+    for path in sorted(inputs):
+      hsh.update(("<%s\0%s\0" % (path, fileHash(path))).encode("utf-8"))
+
+    for path in sorted(outputs):
+      hsh.update((">%s\0" % (path)).encode("utf-8"))
+
+    return hsh.hexdigest()
+
+  def restore(self, key, outputs):
+    with self.lock():
+      try:
+        with open(self.entryPath(key)) as fl:
+          entry = json.load(fl)
+      except (IOError, OSError, ValueError):
+        return None
+
+      files = entry.get("outputs", {})
+
+      if sorted(files) != sorted(outputs): return None
+
+      if not all(
+          os.path.isfile(self.blobPath(files[path]["blob"])) for path in files
+      ):
+        return None
+
+      for path in outputs:
+        parent = os.path.dirname(path)
+        if parent and not os.path.isdir(parent): os.makedirs(parent)
+
+        tmp = "%s.%i.tmp" % (path, os.getpid())
+        shutil.copyfile(self.blobPath(files[path]["blob"]), tmp)
+        os.chmod(tmp, files[path]["mode"])
+        getattr(os, "replace", os.rename)(tmp, path)
+
+      os.utime(self.entryPath(key), None)
+
+    return entry.get("log", "")
+
+  def save(self, key, outputs, log):
+    files = dict()
+    added = 0
+
+    with self.lock():
+      for path in outputs:
+        digest = fileHash(path)
+        blob = self.blobPath(digest)
+
+        if not os.path.isfile(blob):
+          tmp = "%s.%i.tmp" % (blob, os.getpid())
+          shutil.copyfile(path, tmp)
+          getattr(os, "replace", os.rename)(tmp, blob)
+          added += os.path.getsize(blob)
+
+        files[path] = {
+          "blob": digest,
+          "mode": os.stat(path).st_mode & 0o7777,
+        }
+
+      writeAtomic(self.entryPath(key), json.dumps({
+        "outputs": files,
+        "log": log,
+      }, sort_keys = True).encode("utf-8"))
+
+    return added
+
+  def evict(self):
+    evicted = 0
+
+    with self.lock(False):
+      entries = list()
+      refs = dict()
+
+      for fil in os.listdir(self.entries):
+        path = os.path.join(self.entries, fil)
+
+        try:
+          with open(path) as fl:
+            blobs = set(
+              out["blob"] for out in json.load(fl)["outputs"].values()
+            )
+        except (IOError, OSError, ValueError, KeyError):
+          os.remove(path)
+          continue
+
+        entries.append((os.path.getmtime(path), path, blobs))
+
+        for blob in blobs:
+          refs[blob] = refs.get(blob, 0) + 1
+
+      total = 0
+
+      # Anything unreferenced is left over from a crashed job
+      for fil in os.listdir(self.blobs):
+        path = os.path.join(self.blobs, fil)
+
+        if fil in refs:
+          total += os.path.getsize(path)
+        else:
+          os.remove(path)
+
+      entries.sort()
+
+      for mtime, path, blobs in entries:
+        if total <= self.maxSize: break
+
+        os.remove(path)
+        evicted += 1
+
+        for blob in blobs:
+          refs[blob] -= 1
+
+          if refs[blob] == 0 and os.path.isfile(self.blobPath(blob)):
+            total -= os.path.getsize(self.blobPath(blob))
+            os.remove(self.blobPath(blob))
+
+    return evicted, total
+
+  def updateStats(self, setSize = None, **kwargs):
+    path = os.path.join(self.path, "stats.json")
+
+    with FileLock(os.path.join(self.path, ".stats.lock")):
+      stats = self.stats()
+
+      for key in kwargs:
+        stats[key] = stats.get(key, 0) + kwargs[key]
+
+      if setSize is not None: stats["size"] = setSize
+
+      writeAtomic(path, json.dumps(stats, sort_keys = True).encode("utf-8"))
+
+    return stats
+
+  def stats(self):
+    try:
+      with open(os.path.join(self.path, "stats.json")) as fl:
+        return json.load(fl)
+    except (IOError, OSError, ValueError):
+      return dict()
+
+
+def run(command):
+  proc = subprocess.Popen(
+    command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT
+  )
+
+  log = proc.communicate()[0]
+  write(log)
+
+  return proc.returncode, log.decode("utf-8", "replace")
+
+
+def write(log):
+  if not isinstance(log, bytes): log = log.encode("utf-8")
+
+  out = getattr(sys.stdout, "buffer", sys.stdout)
+  out.write(log)
+  out.flush()
+
+
+def printStats(store):
+  stats = store.stats()
+  hits = stats.get("hits", 0)
+  misses = stats.get("misses", 0)
+  total = hits + misses
+
+  for key in ["hits", "misses", "uncacheable", "evicted"]:
+    print("%-12s %i" % (key, stats.get(key, 0)))
+
+  print("%-12s %.1f MiB / %.1f MiB" % (
+    "size", stats.get("size", 0) / 1048576.0, store.maxSize / 1048576.0
+  ))
+
+  if total: print("%-12s %.1f%%" % ("hit rate", 100.0 * hits / total))
+
+  return 0
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+    description = "Run a build command through a content-addressed output "
+    "cache."
+  )
+  parser.add_argument("-s", "--store", required = True, help = "cache directory")
+  parser.add_argument(
+    "-m", "--max-size", type = int, default = 1024,
+    help = "evict least recently used entries beyond this many MiB"
+  )
+  parser.add_argument(
+    "-e", "--env", action = "append", default = [],
+    help = "environment variable that affects the outputs"
+  )
+  parser.add_argument(
+    "-i", "--inputs", action = "append", default = [],
+    help = "whitespace-separated input files"
+  )
+  parser.add_argument(
+    "-o", "--outputs", action = "append", default = [],
+    help = "whitespace-separated output files"
+  )
+  parser.add_argument(
+    "--stats", action = "store_true", help = "print cache statistics and exit"
+  )
+  parser.add_argument("command", nargs = "*", help = "shell command to run")
+  opts = parser.parse_args(argv)
+
+  store = Store(opts.store, opts.max_size * 1048576)
+
+  if opts.stats: return printStats(store)
+
+  if not opts.command: parser.error("no command given")
+
+  command = " ".join(opts.command)
+  inputs = [path for arg in opts.inputs for path in arg.split()]
+  outputs = [path for arg in opts.outputs for path in arg.split()]
+
+  if not outputs or not all(os.path.isfile(path) for path in inputs):
+    store.updateStats(uncacheable = 1)
+    return run(command)[0]
+
+  key = store.key(command, inputs, outputs, opts.env)
+  log = store.restore(key, outputs)
+
+  if log is not None:
+    write(log)
+    store.updateStats(hits = 1)
+    return 0
+
+  code, log = run(command)
+
+  if code != 0 or not all(os.path.isfile(path) for path in outputs):
+    store.updateStats(uncacheable = 1)
+    return code
+
+  added = store.save(key, outputs, log)
+  stats = store.updateStats(misses = 1, size = added)
+
+  if stats["size"] > store.maxSize:
+    evicted, size = store.evict()
+    store.updateStats(evicted = evicted, setSize = size)
+
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
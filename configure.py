@@ -1,25 +1,38 @@
 """Build configuration stuff."""
 
-import collections
+import errno
+import fnmatch
+import gc
+import hashlib
+import json
 import logging
 import os
+import pickle
 import re
 import shutil
+import signal
 import subprocess
 import sys
+import threading
 import time
+import zlib
 
 try:
   isinstance("hi", basestring)
 except NameError:
   basestring = str
 
+try:
+  from collections.abc import Iterable
+except ImportError:
+  from collections import Iterable
+
 
 class BuildPath(object):
   @staticmethod
-  def expand(value, rootDir, buildDir):
+  def expand(value, rootDir, buildDir, dirVars = None):
     if isinstance(value, BuildPath):
-      value = value.toString(rootDir, buildDir)
+      value = value.toString(rootDir, buildDir, dirVars)
 
     return value
 
@@ -45,9 +58,23 @@ class BuildPath(object):
   def __ne__(self, rhs):
     return not self.__eq__(rhs)
 
-  def toString(self, rootDir, buildDir):
+  def __reduce__(self):
+    return BuildPath, (self._value, self._atRoot)
+
+  def toString(self, rootDir, buildDir, dirVars = None):
+    if dirVars is not None:
+      dirVar = dirVars.get(self._dirKey())
+
+      if dirVar is not None:
+        return os.path.join(dirVar, os.path.basename(self._value))
+
     return os.path.join(rootDir if self._atRoot else buildDir, self._value)
 
+  def _dirKey(self):
+    if os.path.isabs(self._value): return None
+
+    return self._atRoot, os.path.dirname(self._value)
+
 
 class BuildDeps(object):
   @staticmethod
@@ -74,26 +101,33 @@ class BuildDeps(object):
 
     self._order = frozenset(order or ())
 
-  def _emit(self, stream, rootDir, buildDir):
+  def __reduce__(self):
+    return BuildDeps, (
+      self._out, self._deps, self._implicit, self._order or None
+    )
+
+  def _emit(self, stream, rootDir, buildDir, dirVars = None):
     parts = list()
 
     if len(self._deps):
       parts.extend([
-        BuildPath.expand(dep, rootDir, buildDir) for dep in self._deps
+        BuildPath.expand(dep, rootDir, buildDir, dirVars) for dep in self._deps
       ])
 
     if len(self._implicit):
       parts.append("|")
 
       parts.extend([
-        BuildPath.expand(dep, rootDir, buildDir) for dep in self._implicit
+        BuildPath.expand(dep, rootDir, buildDir, dirVars)
+        for dep in self._implicit
       ])
 
     if len(self._order):
       parts.append("||")
 
       parts.extend([
-        BuildPath.expand(dep, rootDir, buildDir) for dep in self._order
+        BuildPath.expand(dep, rootDir, buildDir, dirVars)
+        for dep in self._order
       ])
 
     stream.write(" ".join(parts))
@@ -106,27 +140,47 @@ class BuildVarHost(object):
   def _keyValid(self, key):
     return True
 
-  def _emitVar(self, stream, rootDir, buildDir, key, value, prefix):
+  def _emitVar(
+      self, stream, rootDir, buildDir, key, value, prefix, dirVars = None
+  ):
     stream.write(
-      "%s%s = %s\n" % (prefix, key, BuildPath.expand(value, rootDir, buildDir))
+      "%s%s = %s\n" %
+      (prefix, key, BuildPath.expand(value, rootDir, buildDir, dirVars))
     )
 
-  def _emitVars(self, stream, rootDir, buildDir, prefix, specials = None):
+  def _emitVars(
+      self, stream, rootDir, buildDir, prefix, specials = None,
+      dirVars = None, skip = None, extra = None
+  ):
     if specials is None: specials = {}
 
-    if len(specials) == 0 and len(self._vars) == 0: return False
+    hostVars = self._vars
+
+    if skip or extra:
+      hostVars = dict(hostVars)
+
+      for key in skip or ():
+        hostVars.pop(key)
+
+      hostVars.update(extra or {})
+
+    if len(specials) == 0 and len(hostVars) == 0: return False
 
     for key in specials:
-      self._emitVar(stream, rootDir, buildDir, key, specials[key], prefix)
+      self._emitVar(
+        stream, rootDir, buildDir, key, specials[key], prefix, dirVars
+      )
 
-    if len(specials) > 0 and len(self._vars) > 0:
+    if len(specials) > 0 and len(hostVars) > 0:
       stream.write("\n")
 
-    for key in self._vars:
+    for key in hostVars:
       if not self._keyValid(key):
         raise ValueError("Invalid key %s" % (key))
 
-      self._emitVar(stream, rootDir, buildDir, key, self._vars[key], prefix)
+      self._emitVar(
+        stream, rootDir, buildDir, key, hostVars[key], prefix, dirVars
+      )
 
     return True
 
@@ -140,18 +194,124 @@ class BuildVarHost(object):
 
 
 class Build(BuildVarHost):
+  snapshotMagic = b"NinjaSnek snapshot 2\n"
+  globSpecial = re.compile(r"[*?[]")
+
+  @staticmethod
+  def _fingerprint(snapshot, inputs):
+    hsh = hashlib.sha1(Build.snapshotMagic)
+    hsh.update(("%i.%i\0" % sys.version_info[:2]).encode("utf-8"))
+
+    paths = [os.path.abspath(__file__)]
+    snapshot = os.path.abspath(snapshot)
+    skip = set([snapshot, "%s.%i.tmp" % (snapshot, os.getpid())])
+
+    if sys.argv and os.path.isfile(sys.argv[0]):
+      paths.append(os.path.abspath(sys.argv[0]))
+
+    paths.extend(BuildPath.extract(path) for path in inputs)
+
+    for path in paths:
+      hsh.update(path.encode("utf-8") + b"\0")
+
+      try:
+        stat = os.stat(path)
+      except OSError:
+        hsh.update(b"missing\0")
+        continue
+
+      # Only track a directory's entries, or writing the snapshot into it
+      # would invalidate the snapshot
+      if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+          if os.path.abspath(os.path.join(path, name)) in skip: continue
+
+          hsh.update(name.encode("utf-8") + b"\0")
+      else:
+        hsh.update(
+          ("%r %i\0" % (stat.st_mtime, stat.st_size)).encode("utf-8")
+        )
+
+    return hsh.hexdigest().encode("ascii")
+
+  @staticmethod
+  def load(path, *inputs):
+    l = logging.getLogger().getChild("NinjaSnek")
+
+    if not os.path.isfile(path): return None
+
+    with open(path, "rb") as fl:
+      if fl.readline() != Build.snapshotMagic: return None
+
+      # The directories the graph globbed are inputs too, so a source added
+      # to or removed from one invalidates the snapshot
+      try:
+        globDirs = json.loads(fl.readline().decode("utf-8"))
+      except ValueError:
+        return None
+
+      inputs = list(inputs) + globDirs
+
+      if fl.readline().strip() != Build._fingerprint(path, inputs):
+        l.debug("Snapshot %s is out of date." % (path))
+        return None
+
+      # Unpickling a big graph otherwise spends most of its time in the GC
+      gcEnabled = gc.isenabled()
+      gc.disable()
+
+      try:
+        build = pickle.load(fl)
+      except Exception as e:
+        l.info("Could not load snapshot %s: %s" % (path, e))
+        return None
+      finally:
+        if gcEnabled: gc.enable()
+
+    l.debug("Loaded snapshot %s." % (path))
+
+    return build
+
   def __init__(self):
     BuildVarHost.__init__(self)
     self._edges = list()
     self._utils = list()
+    self._batches = list()
     self._ruleList = list()
     self._rules = dict()
     self._targets = dict()
     self._defaults = set()
     self._repo = None
+    self._profiler = None
+    self._minimize = False
+    self._prune = None
+    self._cache = None
+    self._configs = list()
+    self._globCache = None
+    self._globDirs = set()
+    self._regen = None
+    self._regenDeps = None
 
     self._rules["phony"] = BuildPhonyRule(self)
 
+  def batch(self, manifest, rule, default = False):
+    batch = BuildBatch(self, manifest, rule)
+    self._batches.append(batch)
+
+    if default: self._defaults.add(batch)
+
+    return batch
+
+  def config(self, name, buildDir, **kwargs):
+    if any(config._name == name for config in self._configs):
+      raise ValueError("Config name already registered.")
+
+    config = BuildConfig(name, buildDir)
+    config.set(**kwargs)
+    self._configs.append(config)
+
+    return config
+
   def deps(self, *args):
     return BuildDeps(False, *args)
 
@@ -166,7 +326,7 @@ class Build(BuildVarHost):
     elif len(args) == 3:
       if isinstance(
           args[2],
-        (basestring, BuildPath, BuildDeps, collections.Iterable)
+        (basestring, BuildPath, BuildDeps, Iterable)
       ):
         rule = deps
         deps = args[2]
@@ -196,49 +356,430 @@ class Build(BuildVarHost):
       self.edge(*arg)
 
   def _emit(self, stream, rootDir, buildDir):
-    usedRules = set()
+    self._updateRegen(rootDir, [buildDir])
+
+    with self.span("resolve"):
+      rules = self._resolve()
 
+    if not self._minimize:
+      with self.span("emit"):
+        self._emitGraph(stream, rootDir, buildDir, rules)
+
+      return
+
+    l = logging.getLogger().getChild("NinjaSnek")
+
+    with self.span("minimize"):
+      plan = self._minimizePlan(rules)
+
+    after = BuildCountingStream(stream)
+
+    with self.span("emit"):
+      self._emitGraph(after, rootDir, buildDir, rules, *plan)
+
+    # Measuring the savings means rendering the whole graph a second time,
+    # so only do it when someone is going to read it
+    if not l.isEnabledFor(logging.DEBUG):
+      l.info("Minimized manifest to %i bytes." % (after._size))
+      return
+
+    before = BuildCountingStream()
+    self._emitGraph(before, rootDir, buildDir, rules)
+
+    l.debug(
+      "Minimized manifest from %i to %i bytes (saved %i)." %
+      (before._size, after._size, before._size - after._size)
+    )
+
+  def _emitGraph(
+      self, stream, rootDir, buildDir, rules, hoisted = None, dirVars = None
+  ):
+    if hoisted is None: hoisted = {}
+
+    self._emitHeader(stream, rootDir, buildDir, dirVars)
+    self._emitRules(stream, rules, hoisted, dirVars)
+    self._emitBody(stream, rules, hoisted, dirVars)
+
+  def _emitHeader(
+      self, stream, rootDir, buildDir, dirVars = None, overrides = None
+  ):
     rootdirName = "rootdir"
     builddirName = "builddir"
 
     if self._emitVars(
         stream, rootDir, buildDir, "",
-      {rootdirName: rootDir, builddirName: buildDir}
+      {rootdirName: rootDir, builddirName: buildDir}, None, None, overrides
     ):
       stream.write("\n")
 
     rootdirName = "$%s" % (rootdirName)
     builddirName = "$%s" % (builddirName)
 
-    for edge in self._edges:
-      usedRules.add(edge.getRule())
+    if dirVars:
+      for key, name in sorted(dirVars.items(), key = lambda item: item[1]):
+        base = rootdirName if key[0] else builddirName
+        stream.write("%s = %s\n" % (name[1:], os.path.join(base, key[1])))
+
+      stream.write("\n")
 
-    for util in self._utils:
-      usedRules.add(self._rules[util._rule])
+  def _emitRules(self, stream, rules, hoisted, dirVars = None):
+    users = self._ruleUsers(rules)
 
     for rule in self._ruleList:
-      if rule in usedRules and rule._emit(stream, rootdirName, builddirName):
+      if rule in users and rule._emit(
+          stream, "$rootdir", "$builddir", dirVars, hoisted.get(rule),
+          users[rule]
+      ):
         stream.write("\n")
 
-    for edge in self._edges:
-      edge._emit(stream, rootdirName, builddirName)
+  def _emitBody(self, stream, rules, hoisted, dirVars = None):
+    rootdirName = "$rootdir"
+    builddirName = "$builddir"
+
+    for host in self._edges + self._utils + self._batches:
+      rule = rules[host]
 
-    for util in self._utils:
-      util._emit(stream, rootdirName, builddirName)
+      host._emit(
+        stream, rootdirName, builddirName, dirVars,
+        hoisted.get(rule) if hoisted else None, rule
+      )
 
     if len(self._defaults):
       stream.write(
         "\ndefault %s\n" % (
           " ".join([
-            BuildPath.expand(name, rootdirName, builddirName)
+            BuildPath.expand(name, rootdirName, builddirName, dirVars)
             for edge in self._defaults for name in edge._targets._deps
           ])
         )
       )
 
+  def _minimizePlan(self, rules):
+    users = self._ruleUsers(rules)
+    hoisted = dict()
+
+    for rule, hosts in users.items():
+      if isinstance(rule, BuildPhonyRule): continue
+
+      try:
+        shared = set(hosts[0]._vars.items())
+
+        for host in hosts[1:]:
+          shared &= set(host._vars.items())
+      except TypeError:
+        continue
+
+      # Edge variables are evaluated eagerly in the edge's scope, but rule
+      # variables lazily; only move values that read the same either way,
+      # and that no remaining edge variable refers to.
+      refs = set()
+
+      for host in hosts:
+        for value in host._vars.values():
+          if isinstance(value, basestring) and "$" in value:
+            refs.update(re.findall(r"\$\{?([a-zA-Z0-9_.-]+)", value))
+
+      shared = dict(
+        (key, value) for key, value in shared
+        if key not in refs and (
+          isinstance(value, BuildPath) or
+          isinstance(value, basestring) and "$" not in value
+        )
+      )
+
+      if len(shared): hoisted[rule] = shared
+
+    counts = dict()
+
+    def count(values):
+      for value in values:
+        if isinstance(value, BuildPath):
+          key = value._dirKey()
+
+          if key is not None and key[1]: counts[key] = counts.get(key, 0) + 1
+
+    for host in self._edges + self._utils + self._batches:
+      deps = host._edgeDeps()
+
+      for part in [host._targets, deps]:
+        count(part._deps)
+        count(part._implicit)
+        count(part._order)
+
+      count(host._vars.values())
+
+    for rule in users:
+      count(rule._vars.values())
+
+    for edge in self._defaults:
+      count(edge._targets._deps)
+
+    dirVars = dict()
+    taken = set(self._vars)
+
+    for rule, hosts in users.items():
+      for host in hosts:
+        taken.update(host._vars)
+
+      taken.update(rule._vars)
+
+    idx = 0
+
+    for key in sorted(counts):
+      base = os.path.join("$rootdir" if key[0] else "$builddir", key[1])
+
+      while "_d%i" % (idx) in taken:
+        idx += 1
+
+      name = "$_d%i" % (idx)
+
+      if counts[key] * (len(base) - len(name)) <= len(name) + len(base) + 3:
+        continue
+
+      dirVars[key] = name
+      idx += 1
+
+    return hoisted, dirVars
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state["_profiler"] = None
+
+    return state
+
+  def glob(self, rootDir, *patterns):
+    if self._globCache is None: self._globCache = BuildGlobCache(None)
+
+    matches = set()
+    skip = set(
+      os.path.abspath(os.path.join(rootDir, config._buildDir))
+      for config in self._configs
+    )
+
+    with self.span("glob", patterns = list(patterns)):
+      for pattern in patterns:
+        if os.path.isabs(pattern):
+          raise ValueError("Glob patterns must be relative to the root.")
+
+        self._glob(rootDir, "", pattern.split("/"), matches, skip)
+
+    return [BuildPath(match) for match in sorted(matches)]
+
+  def _glob(self, rootDir, rel, parts, matches, skip):
+    if len(parts) == 0:
+      if rel: matches.add(rel)
+      return
+
+    part = parts[0]
+
+    if part in ["", "."]:
+      return self._glob(rootDir, rel, parts[1:], matches, skip)
+
+    path = os.path.abspath(os.path.join(rootDir, rel))
+
+    if path in skip: return
+
+    # A literal component needs no listing, and recording its parent would
+    # make unrelated changes there (like a tool's scratch dir appearing in
+    # the root) re-run configure
+    if not Build.globSpecial.search(part):
+      child = os.path.join(rel, part)
+      childPath = os.path.join(path, part)
+
+      if os.path.isdir(childPath) or (
+          len(parts) == 1 and os.path.lexists(childPath)
+      ):
+        self._glob(rootDir, child, parts[1:], matches, skip)
+
+      return
+
+    entries = self._globCache._list(path)
+
+    if entries is None: return
+
+    # Never descend into a build dir (ours, or anyone else's), since its
+    # contents and mtimes change with every build
+    if rel and ("build.ninja", False) in entries: return
+
+    self._globDirs.add(path)
+
+    if part == "**":
+      self._glob(rootDir, rel, parts[1:], matches, skip)
+
+      for name, isDir in entries:
+        if isDir and not name.startswith("."):
+          self._glob(rootDir, os.path.join(rel, name), parts, matches, skip)
+
+      return
+
+    for name, isDir in entries:
+      if name.startswith(".") and not part.startswith("."): continue
+
+      if (len(parts) == 1 or isDir) and fnmatch.fnmatchcase(name, part):
+        self._glob(rootDir, os.path.join(rel, name), parts[1:], matches, skip)
+
   def _keyValid(self, key):
     return key != "builddir"
 
+  def _spawn(self, fn, procinfo, **kwargs):
+    if self._profiler is None: return fn(procinfo, **kwargs)
+
+    with self.span(
+        " ".join([os.path.basename(procinfo[0])] + procinfo[1:2]),
+        "subprocess",
+        argv = procinfo
+    ):
+      return fn(procinfo, **kwargs)
+
+  def _cacheVars(self, host, rootDir, buildDir, dirVars = None, rule = None):
+    if rule is None: rule = host._ruleObj()
+
+    if self._cache is None or rule._cacheEnv is None: return None
+
+    return self._cache._hostVars(host, rootDir, buildDir, dirVars)
+
+  def _outputSet(self, rootDir, buildDir):
+    outputs = set()
+    inputs = set()
+
+    def expand(paths):
+      return [
+        os.path.abspath(BuildPath.expand(path, rootDir, buildDir))
+        for path in paths
+      ]
+
+    for host in self._edges + self._utils + self._batches:
+      deps = host._edgeDeps()
+
+      for part in [deps._deps, deps._implicit, deps._order]:
+        inputs.update(expand(part))
+
+      if isinstance(host, BuildUtil) or isinstance(
+          host._ruleObj(), BuildPhonyRule
+      ):
+        continue
+
+      outputs.update(expand(host._targets._deps))
+      outputs.update(expand(host._targets._implicit))
+
+    return outputs, inputs
+
+  def _pruneOutputs(self, l, rootDir, buildDir):
+    indexPath = os.path.join(buildDir, ".output_index")
+    outputs, inputs = self._outputSet(rootDir, buildDir)
+    inputs.add(os.path.abspath(os.path.join(buildDir, "build.ninja")))
+    old = set()
+
+    if os.path.isfile(indexPath):
+      with open(indexPath, "rb") as fl:
+        try:
+          old = set(zlib.decompress(fl.read()).decode("utf-8").split("\n"))
+        except (zlib.error, UnicodeDecodeError):
+          l.info("Ignoring corrupt output index %s." % (indexPath))
+
+      old.discard("")
+
+    # Anything not pruned this time stays listed so a later run can get it
+    keep = set()
+    buildDir = os.path.abspath(buildDir)
+
+    for path in sorted(old - outputs - inputs):
+      if not os.path.isfile(path) and not os.path.islink(path): continue
+
+      if self._prune is None:
+        keep.add(path)
+        continue
+
+      # Outputs outside the build dir may since have become sources, so
+      # only report them
+      if not path.startswith(buildDir + os.sep):
+        l.info("Not removing stale output %s outside %s" % (path, buildDir))
+        continue
+
+      if self._prune == "dry":
+        l.info("Would remove stale output %s" % (path))
+        keep.add(path)
+        continue
+
+      try:
+        os.remove(path)
+      except OSError as e:
+        l.info("Could not remove stale output %s: %s" % (path, e))
+        keep.add(path)
+        continue
+
+      l.info("Removed stale output %s" % (path))
+
+      parent = os.path.dirname(path)
+
+      while parent.startswith(buildDir + os.sep) and not os.listdir(parent):
+        os.rmdir(parent)
+        parent = os.path.dirname(parent)
+
+    index = outputs | keep
+
+    if index != old:
+      with open(indexPath, "wb") as fl:
+        fl.write(zlib.compress("\n".join(sorted(index)).encode("utf-8")))
+
+  def minimize(self, enable = True):
+    self._minimize = enable
+
+  # Implicit rules are looked up by extension, so this is done once per
+  # emission and handed down rather than redone by every pass over the graph
+  def _resolve(self):
+    return dict(
+      (host, host._ruleObj())
+      for host in self._edges + self._utils + self._batches
+    )
+
+  def _ruleUsers(self, rules):
+    users = dict()
+
+    for host in self._edges + self._utils + self._batches:
+      users.setdefault(rules[host], list()).append(host)
+
+    return users
+
+  # Globbed directories become phony inputs of the regeneration edge, so
+  # adding or removing an entry in one (or the directory itself) re-runs
+  # configure.  Directories the build writes into are left out, or every
+  # build would re-run configure
+  def _updateRegen(self, rootDir, buildDirs):
+    if self._regen is None: return
+
+    phony = set()
+
+    for edge in self._edges:
+      if edge._rule == "phony" and len(edge._deps._deps) == 0:
+        phony.update(edge._targets._deps)
+
+    rootDir = os.path.abspath(rootDir)
+    buildDirs = [os.path.abspath(buildDir) for buildDir in buildDirs]
+    written = set(
+      os.path.dirname(path)
+      for path in self._outputSet(rootDir, buildDirs[0])[0]
+    )
+    dirs = list()
+
+    for path in sorted(self._globDirs):
+      if path in written or any(
+          path == buildDir or path.startswith(buildDir + os.sep)
+          for buildDir in buildDirs
+      ):
+        continue
+
+      if path == rootDir: dirs.append(BuildPath("."))
+      elif path.startswith(rootDir + os.sep):
+        dirs.append(BuildPath(os.path.relpath(path, rootDir)))
+      else:
+        dirs.append(path)
+
+    for path in dirs:
+      if path not in phony: self.edge(path, "phony", BuildDeps(False, []))
+
+    self._regen._deps = BuildDeps(False, self._regenDeps, dirs)
+
   def outs(self, *args):
     return BuildDeps(True, *args)
 
@@ -260,6 +801,24 @@ class Build(BuildVarHost):
       for arg in args
     ]
 
+  def profile(self, trace = None, summary = None, sampleInterval = None):
+    self._profiler = BuildProfiler(trace, summary)
+
+    if sampleInterval: self._profiler.startSampling(sampleInterval)
+
+    return self._profiler
+
+  def prune(self, enable = True, dryRun = False):
+    self._prune = ("dry" if dryRun else "prune") if enable else None
+
+  def regenerate(self, rule, *deps):
+    self._regenDeps = list(deps)
+    self._regen = self.edge(
+      self.path_b("build.ninja"), rule, self.deps(self._regenDeps)
+    )
+
+    return self._regen
+
   def rule(self, name, **kwargs):
     if name in self._rules:
       raise ValueError("Rule name already registered.")
@@ -301,39 +860,162 @@ class Build(BuildVarHost):
     return rule
 
   def run(self, rootDir, buildDir, *args):
+    return self._runProfiled(self._run, rootDir, buildDir, args)
+
+  def runConfigs(self, rootDir, *args):
+    return self._runProfiled(self._runConfigs, rootDir, args)
+
+  def _runProfiled(self, fn, *args):
     l = logging.getLogger().getChild("NinjaSnek")
 
-    buildDir = os.path.join(rootDir, buildDir)
-    buildFile = os.path.join(buildDir, "build.ninja")
+    if self._profiler is None: return fn(l, *args)
 
+    self._profiler._record(
+      "configure", "phase", self._profiler._start, time.time(), {}
+    )
+
+    try:
+      with self.span("run"):
+        return fn(l, *args)
+    finally:
+      self._profiler.stopSampling()
+      self._profiler.export(l)
+
+  def _makeBuildDir(self, buildDir):
     if os.path.exists(buildDir):
       if not os.path.isdir(buildDir):
         raise ValueError("Invalid build directory %s" % (buildDir))
     else:
       os.makedirs(buildDir)
 
+  def _run(self, l, rootDir, buildDir, args):
+    buildDir = os.path.join(rootDir, buildDir)
+    buildFile = os.path.join(buildDir, "build.ninja")
+
+    self._makeBuildDir(buildDir)
+
+    if self._globCache is not None: self._globCache._save()
+
+    for batch in self._batches:
+      batch._write(rootDir, buildDir)
+
     with open(buildFile, "w") as fs:
       self._emit(fs, rootDir, buildDir)
 
+    with self.span("prune"):
+      self._pruneOutputs(l, rootDir, buildDir)
+
+    return self._ninja(l, buildDir, buildFile, args)
+
+  def _runConfigs(self, l, rootDir, args):
+    for buildDir, buildFile in self._emitConfigs(l, rootDir):
+      retcode = self._ninja(l, buildDir, buildFile, args)
+
+      if retcode != 0: return retcode
+
+    return 0
+
+  def _emitConfigs(self, l, rootDir):
+    if len(self._configs) == 0: raise ValueError("No configs registered.")
+
+    buildDirs = [
+      os.path.join(rootDir, config._buildDir) for config in self._configs
+    ]
+
+    self._updateRegen(rootDir, buildDirs)
+
+    for buildDir in buildDirs:
+      self._makeBuildDir(buildDir)
+
+    if self._globCache is not None: self._globCache._save()
+
+    with self.span("resolve"):
+      rules = self._resolve()
+
+    hoisted, dirVars = {}, None
+
+    if self._minimize:
+      with self.span("minimize"):
+        hoisted, dirVars = self._minimizePlan(rules)
+
+    # Everything below the header only refers to $rootdir and $builddir, so
+    # it's the same text for every config
+    with self.span("emit"):
+      ruleText = BuildStringStream()
+      self._emitRules(ruleText, rules, hoisted, dirVars)
+      ruleText = ruleText.getvalue()
+
+      body = BuildStringStream()
+      self._emitBody(body, rules, hoisted, dirVars)
+      body = body.getvalue()
+
+    errors = list()
+
+    def writeConfig(config, buildDir):
+      try:
+        with self.span("config", config = config._name):
+          for batch in self._batches:
+            batch._write(rootDir, buildDir)
+
+          # Every config gets its own copy of the rules, so deleting one
+          # build dir never breaks another
+          rulesFile = os.path.join(buildDir, "rules.ninja")
+
+          with open(rulesFile, "w") as fs:
+            fs.write(ruleText)
+
+          with open(os.path.join(buildDir, "build.ninja"), "w") as fs:
+            self._emitHeader(fs, rootDir, buildDir, dirVars, config._vars)
+            fs.write("include %s\n\n" % (rulesFile))
+            fs.write(body)
+
+          with self.span("prune", config = config._name):
+            self._pruneOutputs(l, rootDir, buildDir)
+      except Exception as e:
+        errors.append(e)
+
+    threads = [
+      threading.Thread(target = writeConfig, args = (config, buildDir))
+      for config, buildDir in zip(self._configs, buildDirs)
+    ]
+
+    for thread in threads:
+      thread.start()
+
+    for thread in threads:
+      thread.join()
+
+    if len(errors): raise errors[0]
+
+    return [
+      (buildDir, os.path.join(buildDir, "build.ninja"))
+      for buildDir in buildDirs
+    ]
+
+  def _ninja(self, l, buildDir, buildFile, args):
+    def communicate(procinfo, **kwargs):
+      return subprocess.Popen(procinfo, **kwargs).communicate()[0]
+
     ninjaPath = "ninja"
 
     def testExe(path):
       try:
         with open(os.devnull) as devnull:
-          subprocess.call([path, "--version"],
-                          stdin = devnull,
-                          stdout = devnull,
-                          stderr = devnull)
+          self._spawn(subprocess.call, [path, "--version"],
+                      stdin = devnull,
+                      stdout = devnull,
+                      stderr = devnull)
 
         return True
       except OSError as e:
-        if e.errno != os.errno.ENOENT: raise
+        if e.errno != errno.ENOENT: raise
 
         return False
 
     ninjaDir = os.path.join(buildDir, "ninja")
 
     def doGitStuff(pythonSucks):
+      ninjaPath = pythonSucks[0]
       remCachePath = os.path.join(buildDir, ".bootstrap_head")
 
       if self._repo is None and testExe(ninjaPath):
@@ -366,22 +1048,20 @@ class Build(BuildVarHost):
 
             return x
 
-          subprocess.check_call(["git", "checkout", "master"],
-                                cwd = ninjaDir,
-                                stdout = subprocess.PIPE,
-                                stderr = subprocess.PIPE)
+          self._spawn(subprocess.check_call, ["git", "checkout", "master"],
+                      cwd = ninjaDir,
+                      stdout = subprocess.PIPE,
+                      stderr = subprocess.PIPE)
 
-          getUpstream = subprocess.Popen(["git", "remote", "show"],
+          upstream = unbytes(self._spawn(communicate, ["git", "remote", "show"],
                                          cwd = ninjaDir,
                                          stdout = subprocess.PIPE,
-                                         stderr = subprocess.PIPE)
-          upstream = unbytes(getUpstream.communicate()[0]).strip()
+                                         stderr = subprocess.PIPE)).strip()
 
-          parseUrl = subprocess.Popen(["git", "remote", "-v"],
-                                      cwd = ninjaDir,
-                                      stdout = subprocess.PIPE,
-                                      stderr = subprocess.PIPE)
-          remoteInfo = unbytes(parseUrl.communicate()[0]).strip()
+          remoteInfo = unbytes(self._spawn(communicate, ["git", "remote", "-v"],
+                                           cwd = ninjaDir,
+                                           stdout = subprocess.PIPE,
+                                           stderr = subprocess.PIPE)).strip()
 
           sameUpstream = False
 
@@ -396,11 +1076,10 @@ class Build(BuildVarHost):
               break
 
           if sameUpstream:
-            parseLoc = subprocess.Popen(["git", "rev-parse", "@"],
-                                        cwd = ninjaDir,
-                                        stdout = subprocess.PIPE,
-                                        stderr = subprocess.PIPE)
-            locOut = unbytes(parseLoc.communicate()[0]).strip()
+            locOut = unbytes(self._spawn(communicate, ["git", "rev-parse", "@"],
+                                         cwd = ninjaDir,
+                                         stdout = subprocess.PIPE,
+                                         stderr = subprocess.PIPE)).strip()
 
             if (
                 os.path.exists(remCachePath) and
@@ -411,12 +1090,13 @@ class Build(BuildVarHost):
             else:
               l.debug("Checking if local Ninja is up-to-date...")
 
-              subprocess.check_call(["git", "fetch"], cwd = ninjaDir)
+              self._spawn(subprocess.check_call, ["git", "fetch"],
+                          cwd = ninjaDir)
 
-              parseRem = subprocess.Popen(["git", "rev-parse", r"@{u}"],
-                                          cwd = ninjaDir,
-                                          stdout = subprocess.PIPE)
-              remOut = (unbytes(parseRem.communicate()[0])).strip()
+              remOut = unbytes(self._spawn(communicate,
+                                           ["git", "rev-parse", r"@{u}"],
+                                           cwd = ninjaDir,
+                                           stdout = subprocess.PIPE)).strip()
 
               with open(remCachePath, 'w') as fil:
                 fil.write(remOut)
@@ -428,14 +1108,16 @@ class Build(BuildVarHost):
             else:
               l.info("Local Ninja out-of-date.  Updating from GitHub...")
 
-              subprocess.check_call(["git", "pull"], cwd = ninjaDir)
+              self._spawn(subprocess.check_call, ["git", "pull"],
+                          cwd = ninjaDir)
 
               bootstrap = True
           else:
             l.info("Local Ninja is from a different repo.  Re-cloning...")
 
             shutil.rmtree(ninjaDir)
-            subprocess.check_call(["git", "clone", repo, ninjaDir])
+            self._spawn(subprocess.check_call,
+                        ["git", "clone", repo, ninjaDir])
 
             bootstrap = True
         else:
@@ -443,22 +1125,23 @@ class Build(BuildVarHost):
 
           if os.path.exists(ninjaDir): shutil.rmtree(ninjaDir)
 
-          subprocess.check_call(["git", "clone", repo, ninjaDir])
+          self._spawn(subprocess.check_call, ["git", "clone", repo, ninjaDir])
 
           bootstrap = True
 
         if bootstrap:
           l.info("Bootstrapping local Ninja...")
 
-          subprocess.check_call([
+          self._spawn(subprocess.check_call, [
             sys.executable, os.path.join(os.getcwd(), ninjaDir, "configure.py"),
             "--bootstrap"
           ],
-                                cwd = ninjaDir)
+                      cwd = ninjaDir)
 
     pythonSucks = [ninjaPath]
     try:
-      doGitStuff(pythonSucks)
+      with self.span("bootstrap"):
+        doGitStuff(pythonSucks)
     except subprocess.CalledProcessError as e:
       l.info("An error occurred trying to do Git stuff.")
 
@@ -473,12 +1156,47 @@ class Build(BuildVarHost):
 
     l.info(" ".join(procinfo))
 
-    retcode = subprocess.call(procinfo)
+    retcode = self._spawn(subprocess.call, procinfo)
 
     l.info("Ninja exited with code %s" % (retcode))
 
     return retcode
 
+  def save(self, path, *inputs):
+    tmpPath = "%s.%i.tmp" % (path, os.getpid())
+
+    with self.span("snapshot"):
+      with open(tmpPath, "wb") as fl:
+        globDirs = sorted(self._globDirs)
+        inputs = list(inputs) + globDirs
+
+        fl.write(Build.snapshotMagic)
+        fl.write(json.dumps(globDirs).encode("utf-8") + b"\n")
+        fl.write(Build._fingerprint(path, inputs) + b"\n")
+
+        gcEnabled = gc.isenabled()
+        gc.disable()
+
+        try:
+          pickle.dump(self, fl, pickle.HIGHEST_PROTOCOL)
+        finally:
+          if gcEnabled: gc.enable()
+
+      getattr(os, "replace", os.rename)(tmpPath, path)
+
+  def span(self, name, cat = "phase", **kwargs):
+    if self._profiler is None: return _nullSpan
+
+    return BuildSpan(self._profiler, name, cat, kwargs)
+
+  def useCache(self, store, maxSize = None, shim = None):
+    self._cache = BuildCache(store, maxSize, shim)
+
+    return self._cache
+
+  def useGlobCache(self, path):
+    self._globCache = BuildGlobCache(path)
+
   def useRepo(self, repo):
     self._repo = repo
 
@@ -490,7 +1208,7 @@ class Build(BuildVarHost):
     elif len(args) == 1:
       if isinstance(
           args[0],
-        (basestring, BuildPath, BuildDeps, collections.Iterable)
+        (basestring, BuildPath, BuildDeps, Iterable)
       ):
         deps = args[0]
       else:
@@ -513,7 +1231,7 @@ class Build(BuildVarHost):
       raise ValueError("Util name already registered.")
 
     idx = len(self._utils)
-    self._utils.append(BuildUtil(targets, rule, deps))
+    self._utils.append(BuildUtil(self, targets, rule, deps))
 
     if default: self._defaults.add(self._utils[idx])
 
@@ -532,18 +1250,27 @@ class BuildEdge(BuildVarHost):
     self._deps = deps
     self._rule = None
 
-  def _emit(self, stream, rootDir, buildDir):
+  def _edgeDeps(self):
+    return self._deps
+
+  def _emit(
+      self, stream, rootDir, buildDir, dirVars = None, hoisted = None,
+      rule = None
+  ):
     stream.write("build ")
 
-    self._targets._emit(stream, rootDir, buildDir)
+    self._targets._emit(stream, rootDir, buildDir, dirVars)
 
-    stream.write(": %s " % (self._getRule()))
+    stream.write(": %s " % (self._getRule() if rule is None else rule._name))
 
-    self._deps._emit(stream, rootDir, buildDir)
+    self._deps._emit(stream, rootDir, buildDir, dirVars)
 
     stream.write("\n")
 
-    self._emitVars(stream, rootDir, buildDir, "  ")
+    self._emitVars(
+      stream, rootDir, buildDir, "  ", None, dirVars, hoisted,
+      self._build._cacheVars(self, rootDir, buildDir, dirVars, rule)
+    )
 
   def _getRule(self):
     if self._rule is not None: return self._rule
@@ -563,6 +1290,9 @@ class BuildEdge(BuildVarHost):
 
     return self._build._targets[targetset].getRule(depset)
 
+  def _ruleObj(self):
+    return self.getRule()
+
   def getRule(self):
     name = self._getRule()
 
@@ -586,48 +1316,549 @@ class BuildEdge(BuildVarHost):
 
 
 class BuildUtil(BuildVarHost):
-  def __init__(self, targets, rule, deps):
+  def __init__(self, build, targets, rule, deps):
     BuildVarHost.__init__(self)
+    self._build = build
     self._targets = targets
     self._rule = rule
     self._deps = deps
 
-  def _emit(self, stream, rootDir, buildDir):
+  def _edgeDeps(self):
+    return self._deps
+
+  def _emit(
+      self, stream, rootDir, buildDir, dirVars = None, hoisted = None,
+      rule = None
+  ):
     stream.write("util ")
 
-    self._targets._emit(stream, rootDir, buildDir)
+    self._targets._emit(stream, rootDir, buildDir, dirVars)
+
+    stream.write(": %s " % (self._rule))
+
+    self._deps._emit(stream, rootDir, buildDir, dirVars)
+
+    stream.write("\n")
+
+    self._emitVars(stream, rootDir, buildDir, "  ", None, dirVars, hoisted)
+
+  def _ruleObj(self):
+    return self._build._rules[self._rule]
+
+
+class BuildBatch(BuildVarHost):
+  def __init__(self, build, manifest, rule):
+    BuildVarHost.__init__(self)
+    self._build = build
+    self._manifest = manifest
+    self._rule = rule
+    self._jobs = list()
+    self._targets = BuildDeps(True, [])
+
+  def _edgeDeps(self):
+    deps = set()
+
+    for job in self._jobs:
+      deps.add(job["input"])
+      deps.update(frm for frm, to in job.get("includes", ()))
+
+    return BuildDeps(False, (self._manifest, ), deps)
+
+  def _emit(
+      self, stream, rootDir, buildDir, dirVars = None, hoisted = None,
+      rule = None
+  ):
+    stream.write("build ")
+
+    self._targets._emit(stream, rootDir, buildDir, dirVars)
 
     stream.write(": %s " % (self._rule))
 
-    self._deps._emit(stream, rootDir, buildDir)
+    self._edgeDeps()._emit(stream, rootDir, buildDir, dirVars)
 
     stream.write("\n")
 
-    self._emitVars(stream, rootDir, buildDir, "  ")
+    self._emitVars(
+      stream, rootDir, buildDir, "  ", None, dirVars, hoisted,
+      self._build._cacheVars(self, rootDir, buildDir, dirVars, rule)
+    )
+
+  def _ruleObj(self):
+    return self._build._rules[self._rule]
+
+  def _write(self, rootDir, buildDir):
+    jobs = list()
+
+    for job in self._jobs:
+      entry = dict(job)
+
+      for key in ["input", "output", "builddir"]:
+        if key in entry:
+          entry[key] = BuildPath.expand(entry[key], rootDir, buildDir)
+
+      if "includes" in entry:
+        entry["includes"] = [
+          BuildPath.expand(frm, rootDir, buildDir) +
+          ("" if to is None else "=%s" % (to)) for frm, to in entry["includes"]
+        ]
+
+      jobs.append(entry)
+
+    content = json.dumps(jobs, indent = 2, sort_keys = True)
+    path = BuildPath.expand(self._manifest, rootDir, buildDir)
+
+    if os.path.isfile(path):
+      with open(path) as fl:
+        if fl.read() == content: return
+
+    with open(path, "w") as fl:
+      fl.write(content)
+
+  # job(output, source, [includes], [args], [num], [builddir])
+  def job(self, output, source, includes = (), args = None, num = None,
+          builddir = None):
+    job = {"input": source, "output": output}
+
+    if len(includes):
+      job["includes"] = [
+        tuple(inc) if isinstance(inc, (tuple, list)) else (inc, None)
+        for inc in includes
+      ]
+
+    if args is not None: job["args"] = list(args)
+    if num is not None: job["num"] = num
+    if builddir is not None: job["builddir"] = builddir
+
+    self._jobs.append(job)
+    self._targets = BuildDeps(True, [job["output"] for job in self._jobs])
+
+    return self
+
+  def jobs(self, *args):
+    for arg in args:
+      self.job(*arg)
+
+    return self
 
 
 class BuildRule(BuildVarHost):
+  reservedKeys = frozenset([
+    "command", "depfile", "deps", "description", "dyndep", "generator",
+    "msvc_deps_prefix", "pool", "restat", "rspfile", "rspfile_content"
+  ])
+
+  varRef = re.compile(r"\$(\$|\{([a-zA-Z0-9_.-]+)\}|([a-zA-Z0-9_-]+))")
+
   def __init__(self, build, name):
     BuildVarHost.__init__(self)
     self._name = name
     self._build = build
+    self._cacheEnv = None
 
-  def _emit(self, stream, rootDir, buildDir):
+  def _emit(
+      self, stream, rootDir, buildDir, dirVars = None, hoisted = None,
+      hosts = None
+  ):
     stream.write("rule %s\n" % (self._name))
 
-    self._emitVars(stream, rootDir, buildDir, "  ")
+    extra = None
+
+    if hoisted:
+      # Ninja only allows its own keys in rules, so anything else shared by
+      # every edge is written straight into the rule variables that use it
+      extra = dict(
+        (key, value) for key, value in hoisted.items()
+        if key in BuildRule.reservedKeys
+      )
+      inline = dict(
+        (key, BuildPath.expand(value, rootDir, buildDir, dirVars))
+        for key, value in hoisted.items() if key not in extra
+      )
+
+      def substitute(match):
+        name = match.group(2) or match.group(3)
+
+        if name in inline: return inline[name]
+
+        return match.group(0)
+
+      for key in self._vars:
+        value = extra.get(key, self._vars[key])
+
+        if inline and isinstance(value, basestring):
+          value = BuildRule.varRef.sub(substitute, value)
+
+        extra[key] = value
+
+    cache = self._build._cache
+
+    if cache is not None and self._cacheEnv is not None:
+      if self._discoversDeps(hoisted, hosts):
+        raise ValueError(
+          "Rule %s uses a depfile and cannot be cached." % (self._name)
+        )
+
+      if extra is None: extra = dict()
+
+      extra["command"] = cache._wrap(
+        extra.get("command", self._vars["command"]), self._cacheEnv, rootDir,
+        buildDir, dirVars
+      )
+
+    self._emitVars(stream, rootDir, buildDir, "  ", None, dirVars, None, extra)
 
     return True
 
+  # Headers found through depfile or deps never reach the cache key, so
+  # neither the rule nor any of its edges may set either
+  def _discoversDeps(self, hoisted, hosts = None):
+    if hosts is None:
+      build = self._build
+      hosts = [
+        host for host in build._edges + build._utils + build._batches
+        if host._ruleObj() is self
+      ]
+
+    varSets = [self._vars, hoisted or {}] + [host._vars for host in hosts]
+
+    return any("depfile" in vars or "deps" in vars for vars in varSets)
+
+  def cache(self, *envVars):
+    self._cacheEnv = list(envVars)
+    return self
+
+  def uncache(self):
+    self._cacheEnv = None
+    return self
+
 
 class BuildPhonyRule(BuildRule):
   def __init__(self, build):
     BuildRule.__init__(self, build, "phony")
 
-  def _emit(self, stream, rootDir, buildDir):
+  def _emit(
+      self, stream, rootDir, buildDir, dirVars = None, hoisted = None,
+      hosts = None
+  ):
+    return False
+
+
+class BuildCache(object):
+  @staticmethod
+  def quote(value):
+    return "'%s'" % (value.replace("'", "'\\''"))
+
+  def __init__(self, store, maxSize = None, shim = None):
+    self._store = store
+    self._maxSize = maxSize
+    self._shim = shim or os.path.join(
+      os.path.dirname(os.path.abspath(__file__)), "cache-shim.py"
+    )
+
+  def _hostVars(self, host, rootDir, buildDir, dirVars = None):
+    deps = host._edgeDeps()
+
+    def expand(paths):
+      return " ".join(sorted(
+        BuildPath.expand(path, rootDir, buildDir, dirVars) for path in paths
+      ))
+
+    return {
+      "cache_in": expand(deps._deps | deps._implicit),
+      "cache_out": expand(host._targets._deps | host._targets._implicit),
+    }
+
+  # The original command goes through as a single argument so the shim's
+  # shell sees exactly what Ninja's would have
+  def _wrap(self, command, envVars, rootDir, buildDir, dirVars = None):
+    parts = [
+      BuildCache.quote(sys.executable), BuildCache.quote(self._shim), "-s",
+      BuildCache.quote(
+        BuildPath.expand(self._store, rootDir, buildDir, dirVars)
+      )
+    ]
+
+    if self._maxSize is not None: parts.extend(["-m", "%i" % (self._maxSize)])
+
+    for name in envVars:
+      parts.extend(["-e", name])
+
+    parts.extend([
+      "-i", "\"$cache_in\"", "-o", "\"$cache_out\"", "--",
+      BuildCache.quote(BuildPath.expand(command, rootDir, buildDir, dirVars))
+    ])
+
+    return " ".join(parts)
+
+
+class BuildConfig(BuildVarHost):
+  def __init__(self, name, buildDir):
+    BuildVarHost.__init__(self)
+    self._name = name
+    self._buildDir = buildDir
+
+
+class BuildGlobCache(object):
+  magic = b"NinjaSnek glob cache 1\n"
+
+  def __init__(self, path):
+    self._path = path
+    self._dirs = None
+    self._seen = dict()
+
+  def __getstate__(self):
+    return {"_path": self._path, "_dirs": None, "_seen": dict()}
+
+  def _load(self):
+    self._dirs = dict()
+
+    if self._path is None or not os.path.isfile(self._path): return
+
+    with open(self._path, "rb") as fl:
+      if fl.readline() != BuildGlobCache.magic: return
+
+      try:
+        self._dirs = pickle.load(fl)
+      except Exception:
+        self._dirs = dict()
+
+  def _list(self, path):
+    path = os.path.abspath(path)
+
+    if path in self._seen: return self._seen[path][1]
+
+    if self._dirs is None: self._load()
+
+    try:
+      mtime = os.stat(path).st_mtime
+    except OSError:
+      return None
+
+    cached = self._dirs.get(path)
+
+    if cached is not None and cached[0] == mtime:
+      entries = cached[1]
+    else:
+      if hasattr(os, "scandir"):
+        entries = [
+          (entry.name, entry.is_dir()) for entry in os.scandir(path)
+        ]
+      else:
+        entries = [
+          (name, os.path.isdir(os.path.join(path, name)))
+          for name in os.listdir(path)
+        ]
+
+      entries = tuple(sorted(entries))
+
+    self._seen[path] = (mtime, entries)
+
+    return entries
+
+  def _save(self):
+    if self._path is None: return
+
+    # A directory changed within the mtime granularity of this scan could
+    # change again without its mtime moving, so leave it out
+    limit = time.time() - 2
+    dirs = dict(
+      (path, entry) for path, entry in self._seen.items() if entry[0] < limit
+    )
+
+    if dirs == self._dirs: return
+
+    tmpPath = "%s.%i.tmp" % (self._path, os.getpid())
+
+    with open(tmpPath, "wb") as fl:
+      fl.write(BuildGlobCache.magic)
+      pickle.dump(dirs, fl, pickle.HIGHEST_PROTOCOL)
+
+    getattr(os, "replace", os.rename)(tmpPath, self._path)
+
+
+class BuildStringStream(object):
+  def __init__(self):
+    self._parts = list()
+
+  def write(self, data):
+    self._parts.append(data)
+
+  def getvalue(self):
+    return "".join(self._parts)
+
+
+class BuildCountingStream(object):
+  def __init__(self, stream = None):
+    self._stream = stream
+    self._size = 0
+
+  def write(self, data):
+    self._size += len(data)
+
+    if self._stream is not None: self._stream.write(data)
+
+
+class BuildSpan(object):
+  def __init__(self, profiler, name, cat, args):
+    self._profiler = profiler
+    self._name = name
+    self._cat = cat
+    self._args = args
+    self._start = None
+
+  def __enter__(self):
+    self._start = time.time()
+    return self
+
+  def __exit__(self, *args):
+    self._profiler._record(
+      self._name, self._cat, self._start, time.time(), self._args
+    )
+
     return False
 
 
+class BuildNullSpan(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+
+_nullSpan = BuildNullSpan()
+
+
+class BuildProfiler(object):
+  def __init__(self, trace = None, summary = None):
+    self._trace = trace
+    self._summary = summary
+    self._start = time.time()
+    self._events = list()
+    self._samples = dict()
+    self._sampleTimes = list()
+    self._sampleInterval = None
+    self._oldHandler = None
+    self._threads = dict()
+
+  def _record(self, name, cat, start, end, args):
+    tid = self._threads.setdefault(
+      threading.current_thread().ident, len(self._threads)
+    )
+
+    self._events.append((name, cat, start, end, tid, args))
+
+  def _sample(self, signum, frame):
+    inner = frame
+    here = os.path.splitext(os.path.abspath(__file__))[0]
+
+    # Blame the innermost frame outside this module, i.e. the user's code
+    while frame is not None and os.path.splitext(
+        os.path.abspath(frame.f_code.co_filename)
+    )[0] == here:
+      frame = frame.f_back
+
+    if frame is None: frame = inner
+    if frame is None: return
+
+    code = frame.f_code
+    key = "%s:%i (%s)" % (code.co_filename, code.co_firstlineno, code.co_name)
+
+    self._samples[key] = self._samples.get(key, 0) + 1
+    self._sampleTimes.append((time.time(), key))
+
+  def startSampling(self, interval):
+    if not hasattr(signal, "setitimer"):
+      raise ValueError("Sampling is not supported on this platform.")
+
+    self._sampleInterval = interval
+    self._oldHandler = signal.signal(signal.SIGPROF, self._sample)
+    signal.siginterrupt(signal.SIGPROF, False)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+  def stopSampling(self):
+    if self._sampleInterval is None: return
+
+    signal.setitimer(signal.ITIMER_PROF, 0, 0)
+    signal.signal(signal.SIGPROF, self._oldHandler or signal.SIG_DFL)
+    self._sampleInterval = None
+
+  def export(self, logger = None):
+    summary = self.summary()
+
+    if logger is not None:
+      for line in summary.split("\n"):
+        logger.info(line)
+
+    if self._summary is not None:
+      with open(self._summary, "w") as fl:
+        fl.write(summary + "\n")
+
+    if self._trace is not None:
+      with open(self._trace, "w") as fl:
+        json.dump(self.traceEvents(), fl)
+
+  def summary(self):
+    spans = dict()
+
+    for name, cat, start, end, tid, args in self._events:
+      span = spans.setdefault((cat, name), [0, 0.0, 0.0])
+      span[0] += 1
+      span[1] += end - start
+      span[2] = max(span[2], end - start)
+
+    lines = ["%-40s %6s %10s %10s %10s" % (
+      "span", "count", "total", "mean", "max"
+    )]
+
+    for (cat, name), (count, total, peak) in sorted(
+        spans.items(), key = lambda item: -item[1][1]
+    ):
+      lines.append("%-40s %6i %9.3fs %9.3fs %9.3fs" % (
+        "%s:%s" % (cat, name), count, total, total / count, peak
+      ))
+
+    if len(self._samples):
+      lines.append("")
+      lines.append("%i samples:" % (sum(self._samples.values())))
+
+      for key, count in sorted(
+          self._samples.items(), key = lambda item: -item[1]
+      )[:20]:
+        lines.append("%8i  %s" % (count, key))
+
+    return "\n".join(lines)
+
+  def traceEvents(self):
+    pid = os.getpid()
+    events = list()
+
+    for name, cat, start, end, tid, args in self._events:
+      events.append({
+        "name": name,
+        "cat": cat,
+        "ph": "X",
+        "ts": (start - self._start) * 1e6,
+        "dur": (end - start) * 1e6,
+        "pid": pid,
+        "tid": tid,
+        "args": args,
+      })
+
+    for when, key in self._sampleTimes:
+      events.append({
+        "name": key,
+        "cat": "sample",
+        "ph": "i",
+        "s": "t",
+        "ts": (when - self._start) * 1e6,
+        "pid": pid,
+        "tid": 0,
+      })
+
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
 class BuildTarget(object):
   def __init__(self):
     self._rules = dict()
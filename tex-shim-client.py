@@ -0,0 +1,105 @@
+import array
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+
+
+def defaultSocket():
+  if os.environ.get("TEX_SHIM_SOCKET"): return os.environ["TEX_SHIM_SOCKET"]
+
+  runDir = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(
+    tempfile.gettempdir(), "tex-shim-%i" % (os.getuid())
+  )
+
+  return os.path.join(runDir, "tex-shim.sock")
+
+
+def peerUid(sock):
+  if not hasattr(socket, "SO_PEERCRED"): return None
+
+  creds = sock.getsockopt(
+    socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+  )
+
+  return struct.unpack("3i", creds)[1]
+
+
+def runRemote(argv):
+  if not hasattr(socket, "SCM_RIGHTS") or not hasattr(socket.socket, "sendmsg"):
+    return None
+
+  path = defaultSocket()
+
+  # The request carries our environment and stdio, so only ever hand it to
+  # a server running as us
+  try:
+    if os.stat(path).st_uid != os.getuid(): return None
+  except OSError:
+    return None
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+  try:
+    sock.connect(path)
+  except socket.error:
+    sock.close()
+    return None
+
+  if peerUid(sock) not in [None, os.getuid()]:
+    sock.close()
+    return None
+
+  try:
+    request = json.dumps({
+      "argv": argv,
+      "cwd": os.getcwd(),
+      "env": dict(os.environ),
+    }).encode("utf-8") + b"\n"
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    sent = sock.sendmsg([request], [(
+      socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [0, 1, 2])
+    )])
+
+    sock.sendall(request[sent:])
+
+    data = b""
+
+    while not data.endswith(b"\n"):
+      chunk = sock.recv(4096)
+
+      if not chunk:
+        sys.stderr.write("tex-shim server hung up without a result.\n")
+        return 1
+
+      data += chunk
+
+    return json.loads(data.decode("utf-8"))["code"]
+  finally:
+    sock.close()
+
+
+# A separate interpreter, so tex-shim runs as a script and its batch workers
+# can import it under any multiprocessing start method
+def runLocal(argv):
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tex-shim.py")
+
+  return subprocess.call([sys.executable, path] + list(argv))
+
+
+def main():
+  code = runRemote(sys.argv[1:])
+
+  if code is None: code = runLocal(sys.argv[1:])
+
+  return code
+
+
+if __name__ == "__main__":
+  sys.exit(main())
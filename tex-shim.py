@@ -1,7 +1,22 @@
+import array
+import hashlib
+import json
+import multiprocessing
 import os
+import re
 import shutil
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import time
+import traceback
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 
 class FlagInfo(object):
@@ -34,19 +49,280 @@ class FlagTracker(object):
     self.flag.vals.append(val)
 
 
-def main():
-  flagDesc = [
-    ("output", ["output"], ["o"],
-     [None]),
-    ("builddir", ["build-dir"], ["b"], [""]),
-    ("args", ["args"], ["a"], [""]),
-    ("number", ["num"], ["n"], ["1"]),
-  ]
+class FileLock(object):
+  def __init__(self, path, shared = False, block = True):
+    self.path = path
+    self.shared = shared
+    self.block = block
+    self.fd = None
+
+  def __enter__(self):
+    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+
+    if fcntl is not None:
+      op = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+      if not self.block: op |= fcntl.LOCK_NB
+
+      try:
+        fcntl.flock(self.fd, op)
+      except (IOError, OSError):
+        os.close(self.fd)
+        self.fd = None
+        raise
+
+    return self
+
+  # With flock this drops the exclusive lock before taking the shared one,
+  # so callers must keep anything that could take the lock out of the gap
+  def share(self):
+    if fcntl is not None: fcntl.flock(self.fd, fcntl.LOCK_SH)
+
+    self.shared = True
+
+  def __exit__(self, *args):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+    return False
+
+
+preambleEnd = re.compile(br"^[^%\n]*\\begin\s*\{document\}", re.M)
+
+
+def findPreamble(path):
+  with open(path, "rb") as fl:
+    data = fl.read()
+
+  match = preambleEnd.search(data)
+
+  if match is None: return None
+
+  preamble = data[:match.start()]
+
+  if b"\\documentclass" not in preamble: return None
+
+  return preamble, data[match.start():]
+
+
+engineVersions = dict()
+
+
+def engineVersion(exe):
+  if exe not in engineVersions:
+    try:
+      with open(os.devnull, "r+") as devnull:
+        proc = subprocess.Popen([exe, "--version"],
+                                stdin = devnull,
+                                stdout = subprocess.PIPE,
+                                stderr = devnull)
+        out = proc.communicate()[0]
+    except OSError:
+      out = b""
+
+    engineVersions[exe] = out.split(b"\n", 1)[0].strip()
+
+  return engineVersions[exe]
+
+
+fileDigests = dict()
+
+
+# The server warms this before forking, so served jobs only rehash includes
+# that changed
+def fileDigest(path):
+  stat = os.stat(path)
+  version = (stat.st_mtime, stat.st_size)
+  cached = fileDigests.get(path)
+
+  if cached is None or cached[0] != version:
+    with open(path, "rb") as fl:
+      cached = fileDigests[path] = (version, hashlib.sha1(fl.read()).digest())
+
+  return cached[1]
+
+
+baseFormats = dict()
+
+
+# Formats are dumped on top of the engine's own, so a TeX update that
+# rebuilds it (or the packages baked into it) has to change the key
+def baseFormat(exe):
+  if exe not in baseFormats:
+    name = "%s.fmt" % (os.path.splitext(os.path.basename(exe))[0])
+    kpsewhich = os.path.join(os.path.dirname(exe), "kpsewhich")
+
+    try:
+      with open(os.devnull, "r+") as devnull:
+        proc = subprocess.Popen([kpsewhich, name],
+                                stdin = devnull,
+                                stdout = subprocess.PIPE,
+                                stderr = devnull)
+        out = proc.communicate()[0]
+    except OSError:
+      out = b""
+
+    baseFormats[exe] = out.strip()
+
+  path = baseFormats[exe]
+
+  try:
+    mtime = os.stat(path).st_mtime if path else None
+  except OSError:
+    mtime = None
 
-  varFlagDesc = [
-    ("includes", ["include"], ["I"]),
-  ]
+  return path + ("\0%r" % (mtime)).encode("utf-8")
 
+
+class FormatCache(object):
+  # A dump can fail for reasons outside the key, like a missing package or
+  # a killed engine, so failures are only remembered for a while
+  failedTtl = 60 * 60
+
+  def __init__(self, path, maxSize):
+    self.path = path
+    self.maxSize = maxSize
+
+    if not os.path.isdir(path): os.makedirs(path)
+
+  def key(self, exe, engineArgs, preamble, incs):
+    hsh = hashlib.sha1()
+
+    for part in [
+        os.path.basename(exe).encode("utf-8"), engineVersion(exe),
+        baseFormat(exe)
+    ]:
+      hsh.update(part + b"\0")
+
+    for arg in engineArgs:
+      hsh.update(arg.encode("utf-8") + b"\0")
+
+    hsh.update(preamble + b"\0")
+
+    # Local packages pulled in by the preamble get baked into the dump too
+    for frm, to in sorted(incs):
+      hsh.update(os.path.basename(to).encode("utf-8") + b"\0")
+
+      if os.path.isfile(frm): hsh.update(fileDigest(frm))
+
+    return hsh.hexdigest()
+
+  def fmtPath(self, key):
+    return os.path.join(self.path, "%s.fmt" % (key))
+
+  def failedPath(self, key):
+    return os.path.join(self.path, "%s.failed" % (key))
+
+  def failedRecently(self, path):
+    try:
+      return time.time() - os.stat(path).st_mtime < self.failedTtl
+    except OSError:
+      return False
+
+  def lock(self, key, shared = False, block = True):
+    return FileLock(os.path.join(self.path, "%s.lock" % (key)), shared, block)
+
+  # Returns the format along with a shared lock on it, which the caller
+  # holds for as long as it uses the format
+  def get(self, key, dump):
+    fmt = self.fmtPath(key)
+    failed = self.failedPath(key)
+    lock = self.lock(key).__enter__()
+    built = False
+
+    try:
+      if self.failedRecently(failed):
+        print("Format %s could not be dumped recently; not using it." % (key))
+        return None, None
+
+      if os.path.isfile(fmt):
+        os.utime(fmt, None)
+      else:
+        print("Building format %s..." % (key))
+
+        dumped = dump()
+
+        if dumped is None:
+          with open(failed, "wb"): pass
+
+          return None, None
+
+        tmp = "%s.%i.tmp" % (fmt, os.getpid())
+        shutil.copy(dumped, tmp)
+        os.rename(tmp, fmt)
+        built = True
+
+        if os.path.isfile(failed): os.remove(failed)
+
+      # Eviction takes this lock too, so it can't slip in while ours is
+      # being downgraded
+      with FileLock(os.path.join(self.path, ".lock")):
+        lock.share()
+    finally:
+      if not lock.shared: lock.__exit__()
+
+    if built: self.evict(key)
+
+    return fmt, lock
+
+  def evict(self, keep):
+    with FileLock(os.path.join(self.path, ".lock")):
+      fmts = list()
+      total = 0
+
+      for fil in os.listdir(self.path):
+        key, ext = os.path.splitext(fil)
+        path = os.path.join(self.path, fil)
+
+        if ext == ".failed" and not self.failedRecently(path):
+          try:
+            os.remove(path)
+          except OSError:
+            pass
+
+        if ext != ".fmt" or not os.path.isfile(path): continue
+
+        stat = os.stat(path)
+        total += stat.st_size
+
+        if key != keep: fmts.append((stat.st_mtime, stat.st_size, key))
+
+      fmts.sort()
+
+      for mtime, size, key in fmts:
+        if total <= self.maxSize: break
+
+        # Jobs hold a shared lock on their format for as long as they use it
+        try:
+          with self.lock(key, block = False):
+            os.remove(self.fmtPath(key))
+            total -= size
+        except (IOError, OSError):
+          pass
+
+
+flagDesc = [
+  ("output", ["output"], ["o"], [None]),
+  ("builddir", ["build-dir"], ["b"], [""]),
+  ("args", ["args"], ["a"], [""]),
+  ("number", ["num"], ["n"], ["1"]),
+  ("fmtcache", ["fmt-cache"], ["f"], [""]),
+  ("fmtcachesize", ["fmt-cache-size"], [], ["1024"]),
+  ("batch", ["batch"], [], [""]),
+  ("jobs", ["jobs"], ["j"], ["0"]),
+  ("report", ["report"], [], [""]),
+  ("serve", ["serve"], [], [""]),
+  ("idletimeout", ["idle-timeout"], [], ["0"]),
+  ("metrics", ["metrics"], ["m"], [""]),
+  ("verbose", ["verbose"], ["v"]),
+]
+
+varFlagDesc = [
+  ("includes", ["include"], ["I"]),
+]
+
+
+def parseFlags(argv):
   flagInf = dict()
   flagNames = dict()
   sFlagNames = dict()
@@ -107,14 +383,14 @@ def main():
         print("Flag '%s' takes no parameters. (Unexpected '%s')" % (name, val))
         return 1
 
-      info.n += 1
+      flag.vals += 1
     else:
       flagTrk.flag = flag
       flagTrk.n = 1 if info.n < 0 else info.n
 
       if val is not None: flagTrk.add(val)
 
-  for arg in sys.argv[1:]:
+  for arg in argv:
     if flagTrk.n > 0: flagTrk.add(arg)
     else:
       handled = False
@@ -154,7 +430,7 @@ def main():
             if ret: return ret
           else:
             for name in rg:
-              ret = doFlag(rg, sFlagNames)
+              ret = doFlag(name, sFlagNames)
 
               if ret: return ret
 
@@ -172,61 +448,266 @@ def main():
     print("Missing flag parameters at end.")
     return 1
 
-  print("Flags: %s,\nArgs: %s" % (repr(flags), repr(args)))
+  return flags, args
 
-  if len(args) < 1:
-    print("No executable specified.")
-    return 1
 
-  if len(args) < 2:
-    print("No input file.")
-    return 1
+def jobFromFlags(flags, args):
+  return {
+    "exe": args[0] if len(args) > 0 else None,
+    "input": args[1] if len(args) > 1 else None,
+    "output": flags["output"].vals[0],
+    "builddir": flags["builddir"].vals[0],
+    "args": [
+      arg for arg in flags["args"].vals[0].split(",") if arg.strip() != ""
+    ],
+    "num": flags["number"].vals[0],
+    "includes": list(flags["includes"].vals),
+    "fmtcache": flags["fmtcache"].vals[0] or
+    os.environ.get("TEX_SHIM_FMT_CACHE", ""),
+    "fmtcachesize": flags["fmtcachesize"].vals[0],
+    "metrics": flags["metrics"].vals[0],
+    "verbose": flags["verbose"].vals > 0,
+  }
 
-  if flags["output"].vals[0] is None:
-    print("No output filename specified.")
-    return 1
 
+def checkJob(job, prefix = ""):
+  for key, msg in [
+    ("exe", "No executable specified."),
+    ("input", "No input file."),
+    ("output", "No output filename specified."),
+  ]:
+    if job[key] is None:
+      print(prefix + msg)
+      return False
+
+  return True
+
+
+rerunHint = re.compile(
+  br"Rerun to get|Label\(s\) may have changed|Please \(?re\)?run|"
+  br"There were undefined references|rerunfilecheck"
+)
+
+
+def rerunReason(path):
+  if not os.path.isfile(path): return None
+
+  with open(path, "rb") as fl:
+    for line in fl:
+      if rerunHint.search(line):
+        return line.strip().decode("utf-8", "replace")
+
+  return None
+
+
+fileLineError = re.compile(br"^([^\s:]+):(\d+): (.*)$")
+texError = re.compile(br"^! (.*)$")
+lineRef = re.compile(br"^l\.(\d+)")
+
+
+class LogParser(object):
+  def __init__(self, names):
+    self.names = names
+    self.errors = list()
+    self.context = 0
+
+  def feed(self, line):
+    line = line.rstrip(b"\r\n")
+    text = line.decode("utf-8", "replace")
+
+    if self.context > 0:
+      error = self.errors[-1]
+      match = lineRef.match(line)
+
+      if match is not None:
+        if error["line"] is None: error["line"] = int(match.group(1))
+
+        self.context = 0
+      else:
+        self.context -= 1
+
+      if line.strip(): error["context"].append(text)
+
+      return self.context == 0
+
+    match = fileLineError.match(line)
+
+    if match is not None:
+      path = match.group(1).decode("utf-8", "replace")
+
+      error = {
+        "file": self.names.get(os.path.normpath(path), path),
+        "line": int(match.group(2)),
+        "message": match.group(3).decode("utf-8", "replace"),
+      }
+    else:
+      match = texError.match(line)
+
+      if match is None: return False
+
+      error = {
+        "file": None,
+        "line": None,
+        "message": match.group(1).decode("utf-8", "replace"),
+      }
+
+    error["context"] = list()
+    self.errors.append(error)
+    self.context = 4
+
+    return False
+
+  def summary(self, default):
+    lines = list()
+
+    for error in self.errors:
+      lines.append("%s:%s: %s" % (
+        error["file"] or default, "?" if error["line"] is None else
+        error["line"], error["message"]
+      ))
+
+      lines.extend("    %s" % (line) for line in error["context"])
+
+    return "\n".join(lines)
+
+
+def nonInteractive(engineArgs):
+  args = list()
+  names = set()
+
+  for arg in engineArgs:
+    name = arg.lstrip("-").split("=", 1)[0]
+    names.add(name)
+
+    if name == "interaction" and arg.split("=", 1)[-1] not in [
+        "batchmode", "nonstopmode"
+    ]:
+      arg = "-interaction=nonstopmode"
+
+    args.append(arg)
+
+  if "interaction" not in names: args.insert(0, "-interaction=nonstopmode")
+  if "halt-on-error" not in names: args.insert(0, "-halt-on-error")
+
+  if not names & set(["file-line-error", "no-file-line-error"]):
+    args.insert(0, "-file-line-error")
+
+  return args
+
+
+def runPass(procinf, cwd, env, out, parser = None):
+  start = time.time()
+  stats = dict()
+  aborted = False
+
+  sys.stdout.flush()
+
+  with open(os.devnull, "rb") as devnull:
+    proc = subprocess.Popen(procinf,
+                            cwd = cwd,
+                            stdin = devnull,
+                            stdout = subprocess.PIPE,
+                            stderr = subprocess.STDOUT,
+                            env = env)
+
+  if out is None: out = getattr(sys.stdout, "buffer", sys.stdout)
+
+  for line in iter(proc.stdout.readline, b""):
+    out.write(line)
+
+    if parser is not None and parser.feed(line):
+      aborted = True
+      proc.terminate()
+      break
+
+  out.flush()
+  proc.stdout.close()
+
+  if hasattr(os, "wait4"):
+    pid, status, usage = os.wait4(proc.pid, 0)
+
+    if os.WIFEXITED(status): proc.returncode = os.WEXITSTATUS(status)
+    else: proc.returncode = -os.WTERMSIG(status)
+
+    stats["user"] = usage.ru_utime
+    stats["sys"] = usage.ru_stime
+    # ru_maxrss is in bytes on macOS and KiB everywhere else
+    stats["maxrss"] = usage.ru_maxrss // (
+      1024 if sys.platform == "darwin" else 1
+    )
+  else:
+    proc.wait()
+
+  # Report an aborted engine as a plain failure rather than a signal
+  if aborted: proc.returncode = 1
+
+  stats["wall"] = time.time() - start
+  stats["code"] = proc.returncode
+  stats["aborted"] = aborted
+
+  return proc.returncode, stats
+
+
+def runJob(job, metrics = None):
+  if metrics is None: metrics = dict()
+
+  start = time.time()
+  metrics["input"] = job["input"]
+  metrics["output"] = job["output"]
+
+  code = compileJob(job, metrics)
+
+  metrics["code"] = code
+  metrics["wall"] = time.time() - start
+
+  if job["metrics"]:
+    with open(job["metrics"], "w") as fl:
+      json.dump(metrics, fl, indent = 2, sort_keys = True)
+
+  return code
+
+
+def compileJob(job, metrics):
   try:
-    number = int(flags["number"].vals[0])
+    number = int(job["num"])
   except ValueError:
     print("Invalid value for --num flag.")
     return 1
 
-  tname = "ts_tmp"
-  while True:
-    tmpdir = os.path.join(os.getcwd(), tname)
+  fmtCache = None
 
+  if job["fmtcache"]:
     try:
-      if not os.path.exists(tmpdir):
-        os.makedirs(tmpdir)
+      fmtCacheSize = int(job["fmtcachesize"]) * 1024 * 1024
+    except ValueError:
+      print("Invalid value for --fmt-cache-size flag.")
+      return 1
 
-        break
-    except OSError as e:
-      print(str(e))
+    fmtCache = FormatCache(
+      os.path.join(os.getcwd(), job["fmtcache"]), fmtCacheSize
+    )
 
-    tname = "_" + tname
+  tmpdir = tempfile.mkdtemp(prefix = "ts_tmp", dir = os.getcwd())
+  fmtLock = None
 
   try:
     cwd = os.getcwd()
 
     infile = os.path.join(
-      tmpdir, "%s.tex" %
-      (os.path.splitext(os.path.basename(flags["output"].vals[0]))[0])
+      tmpdir, "%s.tex" % (os.path.splitext(os.path.basename(job["output"]))[0])
     )
 
     tmpoutfile = "%s%s" % (
-      os.path.splitext(infile)[0], os.path.splitext(flags["output"].vals[0])[1]
+      os.path.splitext(infile)[0], os.path.splitext(job["output"])[1]
     )
 
-    outfile = os.path.join(cwd, flags["output"].vals[0])
-
-    builddir = os.path.join(cwd, flags["builddir"].vals[0])
+    outfile = os.path.join(cwd, job["output"])
 
-    os.symlink(os.path.join(cwd, args[1]), infile)
+    builddir = os.path.join(cwd, job["builddir"])
 
     incs = list()
 
-    for inc in flags["includes"].vals:
+    for inc in job["includes"]:
       split = inc.split("=", 1)
       frm = split[0]
 
@@ -240,73 +721,211 @@ def main():
         print("Include file {} not found.".format(frm))
         return 1
 
-      incs.append(to)
+      incs.append((frm, to))
 
       print("%s -> %s" % (frm, to))
       os.symlink(frm, to)
 
-    oldwd = cwd
-    os.chdir(tmpdir)
-    cwd = tmpdir
+    engineLog = None
 
-    try:
-      procinf = [args[0]]
-      procinf.extend([
-        arg for arg in flags["args"].vals[0].split(",") if arg.split() != ""
+    if not job["verbose"]:
+      engineLog = open("%s.engine.log" % (os.path.splitext(infile)[0]), "wb")
+
+    engineArgs = job["args"]
+
+    fmt = None
+    preamble = None
+
+    if fmtCache is not None:
+      preamble = findPreamble(os.path.join(cwd, job["input"]))
+
+      if preamble is None:
+        print("No preamble found; not using a format.")
+
+    if preamble is not None:
+      fmtKey = fmtCache.key(job["exe"], engineArgs, preamble[0], incs)
+
+      def dump():
+        jobname = "%s_fmt" % (fmtKey)
+        dumpfile = os.path.join(tmpdir, "%s.tex" % (jobname))
+
+        with open(dumpfile, "wb") as fl:
+          fl.write(preamble[0] + b"\\dump\n")
+
+        procinf = [
+          job["exe"], "-ini", "-interaction=batchmode",
+          "-jobname=%s" % (jobname),
+          "&%s" % (os.path.splitext(os.path.basename(job["exe"]))[0])
+        ]
+        procinf.extend(engineArgs)
+        procinf.append(dumpfile)
+
+        retcode, stats = runPass(procinf, tmpdir, None, engineLog)
+        metrics["format"]["dump"] = stats
+
+        built = os.path.join(tmpdir, "%s.fmt" % (jobname))
+
+        if retcode or not os.path.isfile(built):
+          print("Format dump exited with code %i" % (retcode))
+          return None
+
+        return built
+
+      metrics["format"] = {"key": fmtKey, "dump": None}
+
+      try:
+        fmt, fmtLock = fmtCache.get(fmtKey, dump)
+      except (IOError, OSError) as e:
+        print(str(e))
+
+      metrics["format"]["used"] = fmt is not None
+
+      for fil in os.listdir(tmpdir):
+        if fil.startswith("%s_fmt." % (fmtKey)):
+          os.remove(os.path.join(tmpdir, fil))
+
+    if fmt is None:
+      os.symlink(os.path.join(cwd, job["input"]), infile)
+    else:
+      # Pad out the preamble so line numbers in errors still match the source
+      with open(infile, "wb") as fl:
+        fl.write(b"\n" * preamble[0].count(b"\n") + preamble[1])
+
+    procinf = [job["exe"]]
+    env = None
+
+    if fmt is not None:
+      procinf.append("-fmt=%s" % (os.path.splitext(os.path.basename(fmt))[0]))
+
+      env = dict(os.environ)
+      env["TEXFORMATS"] = os.pathsep.join([
+        os.path.dirname(fmt), env.get("TEXFORMATS", "")
       ])
-      procinf.append(infile)
 
-      print("Process info: %s" % repr(procinf))
+    procinf.extend(nonInteractive(engineArgs))
+    procinf.append(infile)
+
+    names = {os.path.normpath(os.path.basename(infile)): job["input"]}
+
+    for frm, inc in incs:
+      names[os.path.normpath(os.path.relpath(inc, tmpdir))] = frm
 
+    for name in list(names):
+      names[os.path.join(tmpdir, name)] = names[name]
+
+    print("Process info: %s" % repr(procinf))
+
+    metrics["engine"] = procinf
+    metrics["passes"] = list()
+
+    try:
       for i in range(number):
         print("Running iteration {}...".format(i + 1))
 
-        proc = subprocess.Popen(procinf, stdin = subprocess.PIPE)
-        proc.communicate()
+        if i == 0:
+          reason = "initial"
+        else:
+          reason = rerunReason("%s.log" % (os.path.splitext(infile)[0]))
 
-        print("Command exited with code %i" % proc.returncode)
+          if reason is None: reason = "fixed pass count"
+          else: reason = "rerun requested: %s" % (reason)
 
-        if proc.returncode: break
+        if engineLog is not None:
+          engineLog.write(("=== Pass %i (%s)\n" % (i + 1, reason)).encode())
+          engineLog.flush()
 
-      if not proc.returncode:
-        shutil.move(tmpoutfile, outfile)
+        parser = LogParser(names)
 
-      for inc in incs:
-        print("X %s" % inc)
-        try:
-          os.unlink(inc)
-        except OSError as e:
-          print(str(e))
-
-      if os.path.exists(builddir):
-        if not os.path.isdir(builddir):
-          print("Invalid build directory '%s'." % (builddir))
-          return 1
-      else:
-        os.makedirs(builddir)
+        retcode, stats = runPass(procinf, tmpdir, env, engineLog, parser)
+        stats["reason"] = reason
+        metrics["passes"].append(stats)
 
-      def cprf(src, dst):
-        for fil in os.listdir(src):
-          frm = os.path.join(src, fil)
-          to = os.path.join(dst, fil)
+        print("Command exited with code %i" % retcode)
 
-          if os.path.isdir(frm):
-            if os.path.exists(to):
-              if os.path.isdir(to): cprf(frm, to)
-              else: raise RuntimeError("Unexpected file '%s'" % (to))
-          elif os.path.isfile(frm):
-            if os.path.exists(to):
-              if os.path.isfile(to): os.remove(to)
-              else: raise RuntimeError("Unexpected directory '%s'" % (to))
+        if retcode:
+          # Nothing came through the console, so fall back to the .log
+          if not len(parser.errors):
+            logfile = "%s.log" % (os.path.splitext(infile)[0])
 
-            shutil.copy(frm, to)
+            if os.path.isfile(logfile):
+              with open(logfile, "rb") as fl:
+                for line in fl:
+                  if parser.feed(line): break
 
-      cprf(tmpdir, builddir)
+          metrics["errors"] = parser.errors
 
-      if proc.returncode: return proc.returncode
+          break
     finally:
-      os.chdir(oldwd)
+      if fmtLock is not None: fmtLock.__exit__()
+
+      if engineLog is not None: engineLog.close()
+
+    publishStart = time.time()
+    published = [0, 0]
+
+    if not retcode:
+      published[0] += 1
+      published[1] += os.path.getsize(tmpoutfile)
+
+      shutil.move(tmpoutfile, outfile)
+    elif len(parser.errors):
+      print(parser.summary(job["input"]))
+    elif engineLog is not None:
+      with open(engineLog.name, "rb") as fl:
+        tail = fl.read().splitlines()[-20:]
+
+      print("Last lines of %s:" % (os.path.basename(engineLog.name)))
+      print(b"\n".join(tail).decode("utf-8", "replace"))
+
+    for frm, inc in incs:
+      print("X %s" % inc)
+      try:
+        os.unlink(inc)
+      except OSError as e:
+        print(str(e))
+
+    if os.path.exists(builddir):
+      if not os.path.isdir(builddir):
+        print("Invalid build directory '%s'." % (builddir))
+        return 1
+    else:
+      os.makedirs(builddir)
+
+    def cprf(src, dst, logsOnly):
+      for fil in os.listdir(src):
+        frm = os.path.join(src, fil)
+        to = os.path.join(dst, fil)
+
+        if logsOnly and not (os.path.isfile(frm) and fil.endswith(".log")):
+          continue
+
+        if os.path.isdir(frm):
+          if os.path.exists(to):
+            if os.path.isdir(to): cprf(frm, to, logsOnly)
+            else: raise RuntimeError("Unexpected file '%s'" % (to))
+        elif os.path.isfile(frm):
+          if os.path.exists(to):
+            if os.path.isfile(to): os.remove(to)
+            else: raise RuntimeError("Unexpected directory '%s'" % (to))
+
+          shutil.copy(frm, to)
+
+          published[0] += 1
+          published[1] += os.path.getsize(to)
+
+    # A failed build only needs its logs; skip copying the rest of the tree
+    cprf(tmpdir, builddir, retcode != 0)
+
+    metrics["publish"] = {
+      "files": published[0],
+      "bytes": published[1],
+      "time": time.time() - publishStart,
+    }
+
+    if retcode: return retcode
   finally:
+    if fmtLock is not None: fmtLock.__exit__()
+
     try:
       shutil.rmtree(tmpdir)
     except OSError as e:
@@ -315,4 +934,344 @@ def main():
   return 0
 
 
-sys.exit(main())
+def runBatchJob(item):
+  idx, job = item
+  start = time.time()
+  metrics = dict()
+  error = None
+
+  try:
+    retcode = runJob(job, metrics)
+  except Exception:
+    retcode = 1
+    error = traceback.format_exc()
+
+  sys.stdout.flush()
+
+  return idx, retcode, time.time() - start, error, metrics
+
+
+def runBatch(flags, args):
+  manifestPath = flags["batch"].vals[0]
+
+  try:
+    with open(manifestPath) as fl:
+      manifest = json.load(fl)
+  except (IOError, ValueError) as e:
+    print("Invalid batch manifest '%s': %s" % (manifestPath, e))
+    return 1
+
+  try:
+    nJobs = int(flags["jobs"].vals[0])
+  except ValueError:
+    print("Invalid value for --jobs flag.")
+    return 1
+
+  if nJobs <= 0: nJobs = multiprocessing.cpu_count()
+
+  # Flags given to the batch itself act as defaults for every job
+  defaults = jobFromFlags(flags, args)
+  defaults["metrics"] = ""
+  jobs = list()
+
+  for i, entry in enumerate(manifest):
+    job = dict(defaults)
+    job.update(entry)
+    job["args"] = list(job["args"])
+    job["includes"] = defaults["includes"] + list(entry.get("includes", ()))
+
+    if not checkJob(job, "Batch job %i: " % (i)): return 1
+
+    jobs.append(job)
+
+  print("Running %i jobs with %i workers..." % (len(jobs), nJobs))
+
+  start = time.time()
+  results = [None] * len(jobs)
+
+  def report(result):
+    idx, retcode, elapsed, error, metrics = result
+    results[idx] = result
+
+    print("[%i/%i] %s: %s (%.2fs)" % (
+      len([r for r in results if r is not None]), len(jobs),
+      jobs[idx]["output"], "failed (%i)" % (retcode) if retcode else "ok",
+      elapsed
+    ))
+
+    if error is not None: print(error)
+
+    sys.stdout.flush()
+
+  if nJobs == 1 or len(jobs) <= 1:
+    for item in enumerate(jobs):
+      report(runBatchJob(item))
+  else:
+    pool = multiprocessing.Pool(min(nJobs, len(jobs)))
+
+    try:
+      for result in pool.imap_unordered(runBatchJob, enumerate(jobs)):
+        report(result)
+    finally:
+      pool.close()
+      pool.join()
+
+  elapsed = time.time() - start
+  failed = [r for r in results if r[1]]
+
+  print("%i of %i jobs failed in %.2fs." % (len(failed), len(jobs), elapsed))
+
+  if flags["report"].vals[0]:
+    entries = list()
+
+    for job, (idx, retcode, jobTime, error, metrics) in zip(jobs, results):
+      entries.append({
+        "input": job["input"],
+        "output": job["output"],
+        "status": "failed" if retcode else "ok",
+        "code": retcode,
+        "time": jobTime,
+        "error": error,
+        "metrics": metrics,
+      })
+
+    with open(flags["report"].vals[0], "w") as fl:
+      json.dump({
+        "time": elapsed,
+        "workers": nJobs,
+        "jobs": entries,
+      }, fl, indent = 2, sort_keys = True)
+
+  return 1 if len(failed) else 0
+
+
+# The socket hands out the server user's privileges, so it only ever lives
+# in a directory private to that user
+def defaultSocket():
+  if os.environ.get("TEX_SHIM_SOCKET"): return os.environ["TEX_SHIM_SOCKET"]
+
+  runDir = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(
+    tempfile.gettempdir(), "tex-shim-%i" % (os.getuid())
+  )
+
+  return os.path.join(runDir, "tex-shim.sock")
+
+
+def peerUid(sock):
+  if not hasattr(socket, "SO_PEERCRED"): return None
+
+  creds = sock.getsockopt(
+    socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+  )
+
+  return struct.unpack("3i", creds)[1]
+
+
+def serveJob(conn, listener):
+  fds = array.array("i")
+  pid = None
+
+  try:
+    data = b""
+
+    while not data.endswith(b"\n"):
+      chunk, ancdata, msgFlags, addr = conn.recvmsg(
+        65536, socket.CMSG_LEN(3 * fds.itemsize)
+      )
+
+      if not chunk: return False
+
+      data += chunk
+
+      for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+          fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+
+    request = json.loads(data.decode("utf-8"))
+
+    if len(fds) != 3: return False
+
+    # Warm anything worth keeping before forking so later jobs inherit it
+    parsed = parseFlags(request["argv"])
+
+    if not isinstance(parsed, int) and not parsed[0]["batch"].vals[0]:
+      job = jobFromFlags(*parsed)
+
+      if job["exe"] is not None and (
+          job["fmtcache"] or request["env"].get("TEX_SHIM_FMT_CACHE")
+      ):
+        engineVersion(job["exe"])
+        baseFormat(job["exe"])
+
+        for inc in job["includes"]:
+          path = os.path.join(request["cwd"], inc.split("=", 1)[0])
+
+          if os.path.isfile(path): fileDigest(path)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    pid = os.fork()
+  finally:
+    # Only the child keeps the client's descriptors
+    if pid != 0:
+      for fd in fds:
+        os.close(fd)
+
+  if pid: return True
+
+  code = 1
+
+  try:
+    listener.close()
+
+    for i, fd in enumerate(fds):
+      os.dup2(fd, i)
+      os.close(fd)
+
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+
+    code = main(request["argv"])
+  except Exception:
+    traceback.print_exc()
+  finally:
+    try:
+      sys.stdout.flush()
+      sys.stderr.flush()
+
+      conn.sendall(json.dumps({"code": code}).encode("utf-8") + b"\n")
+    finally:
+      os._exit(0)
+
+
+def serve(path, idleTimeout):
+  if not hasattr(socket, "SCM_RIGHTS") or not hasattr(socket.socket, "recvmsg"):
+    print("Serving is not supported on this platform.")
+    return 1
+
+  sockDir = os.path.dirname(os.path.abspath(path))
+
+  if not os.path.isdir(sockDir): os.makedirs(sockDir, 0o700)
+
+  # Anyone who can write to the directory can swap the socket out, unless
+  # it's sticky
+  dirStat = os.lstat(sockDir)
+
+  if dirStat.st_uid not in [os.getuid(), 0] or (
+      dirStat.st_mode & 0o022 and not dirStat.st_mode & 0o1000
+  ):
+    print("Refusing to serve from '%s', which is not private." % (sockDir))
+    return 1
+
+  if os.path.exists(path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+      probe.connect(path)
+      print("A server is already listening on '%s'." % (path))
+      return 1
+    except socket.error:
+      os.remove(path)
+    finally:
+      probe.close()
+
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  umask = os.umask(0o177)
+
+  try:
+    listener.bind(path)
+  finally:
+    os.umask(umask)
+
+  os.chmod(path, 0o600)
+  listener.listen(64)
+  listener.settimeout(1.0)
+
+  print("Serving on '%s'..." % (path))
+  sys.stdout.flush()
+
+  lastJob = time.time()
+  children = 0
+
+  try:
+    while True:
+      try:
+        conn, addr = listener.accept()
+      except socket.timeout:
+        conn = None
+
+      # Jobs run with this user's privileges, so nobody else gets to submit
+      # them
+      if conn is not None and peerUid(conn) not in [None, os.getuid()]:
+        conn.close()
+        conn = None
+
+      if conn is not None:
+        conn.settimeout(None)
+
+        # A bad request only costs its own connection
+        try:
+          if serveJob(conn, listener): children += 1
+        except Exception:
+          traceback.print_exc()
+        finally:
+          conn.close()
+
+        lastJob = time.time()
+
+      while children:
+        try:
+          pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+          children = 0
+          break
+
+        if not pid: break
+
+        children -= 1
+
+      if idleTimeout and not children and time.time() - lastJob > idleTimeout:
+        print("Idle for %is; shutting down." % (idleTimeout))
+        break
+  except KeyboardInterrupt:
+    pass
+  finally:
+    listener.close()
+    os.remove(path)
+
+  return 0
+
+
+def main(argv):
+  parsed = parseFlags(argv)
+
+  if isinstance(parsed, int): return parsed
+
+  flags, args = parsed
+
+  if flags["serve"].vals[0]:
+    try:
+      idleTimeout = int(flags["idletimeout"].vals[0])
+    except ValueError:
+      print("Invalid value for --idle-timeout flag.")
+      return 1
+
+    path = flags["serve"].vals[0]
+
+    return serve(defaultSocket() if path == "-" else path, idleTimeout)
+
+  if flags["batch"].vals[0]: return runBatch(flags, args)
+
+  print("Flags: %s,\nArgs: %s" % (repr(flags), repr(args)))
+
+  job = jobFromFlags(flags, args)
+
+  if not checkJob(job): return 1
+
+  return runJob(job)
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))